@@ -58,5 +58,5 @@ from .widgets import FIELD_ACTION_VALUE, FIELD_ACTION_COUNT, FIELD_ACTION_AVG,\
         FIELD_ACTION_DISTINCT_COUNT, BAND_WIDTH
 from .graphics import RoundRect, Rect, Line, Circle, Arc, Ellipse, Image
 from .exceptions import EmptyQueryset, ObjectNotFound, ManyObjectsFound, AbortEvent
-from .cross_reference import CrossReferenceMatrix
+from .cross_reference import CrossReferenceMatrix, StreamingCrossReferenceMatrix
 
@@ -0,0 +1,317 @@
+"""Aggregation engine used by generators to calculate ObjectValue actions (sum, avg,
+count, min, max and distinct_count) folding each object just once into running
+accumulators, instead of walking through the whole queryset for every aggregated
+widget rendered."""
+
+import re
+
+from .utils import FIELD_ACTION_COUNT, FIELD_ACTION_AVG, FIELD_ACTION_MIN,\
+        FIELD_ACTION_MAX, FIELD_ACTION_SUM, FIELD_ACTION_DISTINCT_COUNT
+
+AGGREGATION_ACTIONS = (FIELD_ACTION_COUNT, FIELD_ACTION_AVG, FIELD_ACTION_MIN,
+        FIELD_ACTION_MAX, FIELD_ACTION_SUM, FIELD_ACTION_DISTINCT_COUNT)
+
+# Finds aggregation functions in prepared expressions, like 'sum("amount")'
+EXP_AGGREGATIONS = re.compile(r'\b(%s)\("([^"]+)"' % '|'.join(AGGREGATION_ACTIONS))
+
+class AggregationSpec(object):
+    """Describes how to get and clean an aggregated value from an object. Widgets
+    with the same class, attribute, 'get_value' and conversion flags share the same
+    spec, and so the same accumulators."""
+
+    widget = None
+    attribute_name = None
+    keeps_distinct = False
+
+    def __init__(self, widget, attribute_name):
+        self.widget = widget
+        self.attribute_name = attribute_name
+
+    def get_value(self, obj):
+        return self.widget.get_object_value(obj, self.attribute_name)
+
+    def clean_value(self, value):
+        return self.widget._clean_empty_value(value)
+
+class Accumulator(object):
+    """Stores the running results of a spec for a scope (the whole report or a
+    group). Its methods return the same as the equivalent ObjectValue actions
+    would return from the list of values."""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.length = 0
+        self.not_none = 0
+        self.total = 0
+        self.minimum = self.maximum = None
+        self.distinct = set() if spec.keeps_distinct else None
+        self.errors = {}
+
+    def fold(self, value):
+        self.length += 1
+
+        if value is not None:
+            self.not_none += 1
+
+            if self.distinct is not None and 'distinct' not in self.errors:
+                try:
+                    self.distinct.add(value)
+                except TypeError as e:
+                    self.errors['distinct'] = e
+
+        # Minimum and maximum values
+        if 'compare' not in self.errors:
+            try:
+                if self.length == 1:
+                    self.minimum = self.maximum = value
+                else:
+                    if value < self.minimum:
+                        self.minimum = value
+                    if value > self.maximum:
+                        self.maximum = value
+            except Exception as e:
+                self.errors['compare'] = e
+
+        # Sum of cleaned values
+        if 'total' not in self.errors:
+            try:
+                self.total = self.total + self.spec.clean_value(value)
+            except Exception as e:
+                self.errors['total'] = e
+
+    def check_error(self, kind=None):
+        """Raises the error got when getting values or calculating the result,
+        the same way the calculation over a list would raise"""
+        error = self.errors.get('value', None) or self.errors.get(kind, None)
+        if error is not None:
+            raise error
+
+    def count(self):
+        self.check_error()
+        return self.not_none
+
+    def avg(self):
+        self.check_error('total')
+        return self.total / self.length
+
+    def min(self):
+        self.check_error('compare')
+        if not self.length:
+            raise ValueError('min() arg is an empty sequence')
+        return self.minimum
+
+    def max(self):
+        self.check_error('compare')
+        if not self.length:
+            raise ValueError('max() arg is an empty sequence')
+        return self.maximum
+
+    def sum(self):
+        self.check_error('total')
+        return self.total
+
+    def distinct_count(self):
+        self.check_error('distinct')
+        return len(self.distinct)
+
+class AggregationEngine(object):
+    """Registers the aggregated widgets of a report when the rendering starts and
+    folds each object into the accumulators of the scopes it belongs to (the whole
+    report and each of its groups) while the generator walks through the objects.
+
+    A scope is identified by the tuple of its groups values (the report scope is an
+    empty tuple). Once a scope is closed (because a group changed or because the
+    objects finished) its results are read in O(1). The results of a scope still
+    being walked (i.e. for page footers and groups' headers) are calculated at
+    once for all specs walking just once on its objects, or are the running values
+    when the queryset is streamed and can't be read again."""
+
+    generator = None
+
+    def __init__(self, generator):
+        self.generator = generator
+        self._specs = {}
+        self._open_keys = []
+        self._open = {}
+        self._closed = {}
+        self._walked = {}
+
+        self.compile()
+
+        # The report scope is open before the first object, as pages headers
+        # and footers are rendered before it
+        if self._specs:
+            self.open_scope(())
+
+    # Compiling
+
+    def compile(self):
+        """Finds the aggregated widgets on report bands and registers their specs"""
+        from .widgets import ObjectValue
+
+        for band in self.get_bands():
+            for element in band.elements:
+                if isinstance(element, ObjectValue):
+                    self.register(element, band)
+
+    def get_bands(self):
+        """Returns the report bands driven by report objects (subreports have
+        their own querysets and aren't considered)"""
+        report = self.generator.report
+        bands = [report.band_begin, report.band_summary, report.band_page_header,
+                report.band_page_footer, report.band_detail]
+
+        for group in report.groups:
+            bands.extend([group.band_header, group.band_footer])
+
+        ret = []
+        while bands:
+            band = bands.pop(0)
+            if band and band not in ret:
+                ret.append(band)
+                bands.extend(band.child_bands or [])
+
+        return ret
+
+    def register(self, widget, band):
+        if widget.expression:
+            found = EXP_AGGREGATIONS.findall(widget.expression)
+        elif widget.action in AGGREGATION_ACTIONS:
+            found = [(widget.action, widget.attribute_name)]
+        else:
+            return
+
+        for action, attribute_name in found:
+            key = self.make_spec_key(widget, attribute_name)
+
+            if key not in self._specs:
+                template = widget.clone()
+                template.generator = self.generator
+                template.report = self.generator.report
+                template.band = band
+
+                self._specs[key] = AggregationSpec(template, attribute_name)
+
+            if action == FIELD_ACTION_DISTINCT_COUNT:
+                self._specs[key].keeps_distinct = True
+
+    def make_spec_key(self, widget, attribute_name):
+        return (widget.__class__, attribute_name, widget.get_value,
+                widget.converts_decimal_to_float, widget.converts_float_to_decimal)
+
+    # Feeding
+
+    def get_scope_keys(self, groups_values):
+        """Returns the keys of all scopes an object belongs to, from the report
+        scope to the most inner group"""
+        values = [groups_values.get(group, None) for group in self.generator.report.groups]
+        return [tuple(values[:num]) for num in range(len(values) + 1)]
+
+    def feed(self, obj, groups_values):
+        """Folds an object into the accumulators of its scopes. Scopes with keys
+        different from the previous object's ones are closed before."""
+        if not self._specs:
+            return
+
+        keys = self.get_scope_keys(groups_values)
+
+        # Closes the changed scopes, keeping only the latest closed ones
+        changed = [key for num, key in enumerate(self._open_keys) if keys[num] != key]
+        if changed:
+            self._closed = {}
+            for key in changed:
+                self._closed[key] = self._open.pop(key)
+                self._walked.pop(key, None)
+
+        for key in keys:
+            if key not in self._open:
+                self.open_scope(key)
+        self._open_keys = keys
+
+        # Folds the object
+        for spec in self._specs.values():
+            try:
+                value = spec.get_value(obj)
+            except Exception as e:
+                for key in keys:
+                    self._open[key][spec].errors.setdefault('value', e)
+                continue
+
+            for key in keys:
+                self._open[key][spec].fold(value)
+
+    def open_scope(self, key):
+        """Makes the empty accumulators of a scope, returning them"""
+        accumulators = self._open[key] = dict([(spec, Accumulator(spec))
+            for spec in self._specs.values()])
+        return accumulators
+
+    def finish(self):
+        """Closes all scopes, because there are no more objects"""
+        self._closed = self._open
+        self._open = {}
+        self._open_keys = []
+        self._walked = {}
+
+    # Reading
+
+    def get_scope_key(self):
+        """Returns the key of the current scope, or None if it is not a scope
+        driven by report objects"""
+        generator = self.generator
+
+        # Customized and SubReports
+        if generator._current_queryset is not None:
+            return None
+
+        # Groups
+        elif generator._groups_stack:
+            groups = self.generator.report.groups
+            values = generator._groups_working_values
+            key = tuple([values[group] for group in groups[:len(values)] if group in values])
+            return len(key) == len(values) and key or None
+
+        return ()
+
+    def walk(self, key):
+        """Calculates all specs walking once on the current queryset"""
+        accumulators = dict([(spec, Accumulator(spec)) for spec in self._specs.values()])
+
+        for obj in self.generator.get_current_queryset():
+            for spec, accumulator in list(accumulators.items()):
+                try:
+                    value = spec.get_value(obj)
+                except Exception as e:
+                    accumulator.errors.setdefault('value', e)
+                else:
+                    accumulator.fold(value)
+
+        self._walked[key] = accumulators
+        return accumulators
+
+    def get_accumulator(self, widget, attribute_name):
+        """Returns the accumulator for the widget in the current scope or None if
+        it is not available, so the widget must calculate the value by itself."""
+        spec = self._specs.get(self.make_spec_key(widget, attribute_name), None)
+        if spec is None:
+            return None
+
+        key = self.get_scope_key()
+        if key is None:
+            return None
+
+        try:
+            if key in self._closed:
+                accumulators = self._closed[key]
+            elif key in self._walked:
+                accumulators = self._walked[key]
+            elif self.generator.report.stream_queryset:
+                # Scopes not reached yet have their running values empty
+                accumulators = self._open.get(key, None) or self.open_scope(key)
+            else:
+                accumulators = self.walk(key)
+        except TypeError: # Unhashable groups values
+            return None
+
+        return accumulators and accumulators[spec] or None
+
@@ -1,7 +1,7 @@
 """Module with BarCodes functions on Geraldo."""
 
 from .graphics import Graphic
-from .utils import memoize, get_attr_value, cm
+from .utils import memoize, get_attr_accessor, cm
 
 from reportlab.graphics.barcode import getCodeNames
 from reportlab.graphics.barcode.common import Codabar, Code11, I2of5, MSI
@@ -87,7 +87,7 @@ class BarCode(Graphic):
                 kwargs['checksum'] = self.checksum
 
                 if self.type in ('USPS_4State',):
-                    kwargs['routing'] = get_attr_value(self.instance, self.routing_attribute)
+                    kwargs['routing'] = get_attr_accessor(self.routing_attribute)(self.instance)
 
                 self._rendered_drawing = cls(**kwargs)
 
@@ -101,7 +101,7 @@ class BarCode(Graphic):
         if self.get_value and instance:
             return self.get_value(instance)
 
-        value = get_attr_value(instance, self.attribute_name)
+        value = get_attr_accessor(self.attribute_name)(instance)
 
         return value
 
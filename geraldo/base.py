@@ -161,6 +161,8 @@ class BaseReport(GeraldoObject):
     queryset = None
     print_if_empty = False # This means if a queryset is empty, the report will
                            # be generated or not
+    stream_queryset = False # This means the objects are consumed one by one from
+                            # the queryset instead of being loaded into a list
 
     # Style and colors
     default_font_color = black
@@ -224,6 +226,24 @@ class BaseReport(GeraldoObject):
 
         return list(self.queryset)
 
+    def get_objects_iterator(self):
+        """Returns an iterator on the objects to be rendered.
+
+        If 'stream_queryset' is True, the queryset is consumed as an iterator
+        (using its method 'iterator' if it exists, like Django QuerySets do), so
+        the objects are not loaded all together in memory. Otherwise, it just
+        iterates on the list returned by 'get_objects_list'."""
+        if not self.stream_queryset:
+            return iter(self.get_objects_list())
+
+        if self.queryset is None:
+            return iter([])
+
+        if callable(getattr(self.queryset, 'iterator', None)):
+            return self.queryset.iterator()
+
+        return iter(self.queryset)
+
     def format_date(self, date, expression):
         """Use a date format string method to return formatted datetime.
 
@@ -395,6 +415,10 @@ class Report(BaseReport, metaclass=ReportMetaclass):
     cache_backend = None
     cache_prefix = None
     cache_file_root = None
+    cache_max_bytes = None # Limits informed to the cache backend, if it supports them
+    cache_timeout = None
+    cache_fingerprint_field = None # Field with the objects updating time, used
+                                   # to get the fingerprint of Django QuerySets
 
     def __init__(self, queryset=None):
         super(Report, self).__init__(queryset)
@@ -424,7 +448,7 @@ class Report(BaseReport, metaclass=ReportMetaclass):
         The arguments *args and **kwargs are passed to class initializer."""
 
         # Check empty queryset and raises an error if this is not acceptable
-        if not self.print_if_empty and not self.queryset:
+        if not self.print_if_empty and self.is_queryset_empty():
             raise EmptyQueryset("This report doesn't accept empty queryset")
 
         # Initialize generator instance
@@ -432,6 +456,14 @@ class Report(BaseReport, metaclass=ReportMetaclass):
 
         return generator.execute()
 
+    def is_queryset_empty(self):
+        """Returns True if the queryset has no objects. When streaming, Django
+        QuerySets are checked with method 'exists' to avoid loading them."""
+        if self.stream_queryset and callable(getattr(self.queryset, 'exists', None)):
+            return not self.queryset.exists()
+
+        return not self.queryset
+
     def generate_under_process_by(self, generator_class, *args, **kwargs):
         """Uses the power of multiprocessing library to run report generation under
         a Process and save memory consumming, with better use of multi-core servers.
@@ -1,9 +1,10 @@
 """Caching functions file. You can use this stuff to store generated reports in a file
 system cache, and save time and performance."""
 
-import os
+import os, re, decimal, datetime, time, threading, collections, tempfile, shutil, hashlib
 
-from .utils import memoize, get_attr_value
+from .utils import get_attr_accessor
+from .exceptions import CacheConfigurationError
 
 try:
     set
@@ -18,6 +19,15 @@ DEFAULT_CACHE_STATUS = CACHE_DISABLED
 CACHE_BACKEND = 'geraldo.cache.FileCacheBackend'
 CACHE_FILE_ROOT = '/tmp/'
 
+# Prefix of temporary files written by file cache backends
+TEMP_FILE_PREFIX = '.tmp-'
+
+def get_umask():
+    """Returns the current umask of the process"""
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
 class BaseCacheBackend(object):
     """This is the base class (and abstract too) to be inherited by any cache backend
     to store and restore reports from a cache."""
@@ -31,40 +41,413 @@ class BaseCacheBackend(object):
     def exists(self, hash_key):
         pass
 
+    def copy_to(self, hash_key, fp):
+        """Writes the stored content into a file object. Returns False if there
+        is no content for the hash key."""
+        content = self.get(hash_key)
+        if not content:
+            return False
+
+        fp.write(content)
+        return True
+
+    def store_file(self, hash_key, fp):
+        """Stores the content read from a file object"""
+        return self.set(hash_key, fp.read())
+
 class FileCacheBackend(BaseCacheBackend):
-    """This cache backend is able to store and restore using a path on the file system."""
+    """This cache backend is able to store and restore using a path on the file system.
+
+    Files are written in a temporary file and renamed, so they are never read
+    half written, and are copied by chunks by 'copy_to' and 'store_file'."""
 
     cache_file_root = '/tmp/'
 
-    def __init__(self, cache_file_root=None):
+    def __init__(self, cache_file_root=None, **kwargs):
+        # Other arguments (i.e. limits informed by reports) are ignored
         self.cache_file_root = cache_file_root or self.cache_file_root
 
         # Creates the directory if doesn't exists
         if not os.path.exists(self.cache_file_root):
             os.makedirs(self.cache_file_root)
 
+    def get_path(self, hash_key):
+        """Returns the file path for a hash key"""
+        return os.path.join(self.cache_file_root, hash_key)
+
+    def open_file(self, hash_key):
+        """Returns the stored file opened for reading, or None if it doesn't exist"""
+        try:
+            return open(self.get_path(hash_key), 'rb')
+        except (IOError, OSError):
+            return None
+
+    def write_file(self, hash_key, write):
+        """Calls the function 'write' with a temporary file opened for writing,
+        and then renames it to the hash key path"""
+        path = self.get_path(hash_key)
+        directory = os.path.dirname(path)
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_FILE_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                write(fp)
+
+            # Temporary files are made readable just by the owner, so the
+            # permissions of a file made by 'open' are given before renaming
+            os.chmod(temp_path, 0o666 & ~get_umask())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        return path
+
     def get(self, hash_key):
         # Returns None if doesn't exists
-        if not self.exists(hash_key):
+        fp = self.open_file(hash_key)
+        if fp is None:
             return None
 
         # Returns the file content
-        fp = file(os.path.join(self.cache_file_root, hash_key), 'rb')
-        content = fp.read()
-        fp.close()
-
-        return content
+        with fp:
+            return fp.read()
 
     def set(self, hash_key, content):
         # Writes the content in the file
-        fp = file(os.path.join(self.cache_file_root, hash_key), 'wb')
-        fp.write(content)
-        fp.close()
+        self.write_file(hash_key, lambda fp: fp.write(content))
+
+    def exists(self, hash_key):
+        return os.path.exists(self.get_path(hash_key))
+
+    def copy_to(self, hash_key, fp):
+        source = self.open_file(hash_key)
+        if source is None:
+            return False
+
+        with source:
+            if not os.fstat(source.fileno()).st_size:
+                return False
+
+            shutil.copyfileobj(source, fp)
+
+        return True
+
+    def store_file(self, hash_key, fp):
+        self.write_file(hash_key, lambda dest: shutil.copyfileobj(fp, dest))
+
+class FileCacheIndex(object):
+    """Sizes and modification times of the files of a cache directory, used to
+    find the oldest ones without listing the directory every time"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.size = 0
+        self.scanned = None
+
+    def scan(self, paths):
+        """Indexes the informed paths of cache files, replacing the current ones"""
+        self.files = {}
+        self.size = 0
+
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            self.add(path, stat.st_size, stat.st_mtime)
+
+        self.scanned = time.time()
+
+    def add(self, path, size, mtime):
+        self.discard(path)
+        self.files[path] = (size, mtime)
+        self.size += size
+
+    def discard(self, path):
+        if path in self.files:
+            self.size -= self.files.pop(path)[0]
+
+_file_indexes = {}
+_file_indexes_lock = threading.Lock()
+
+class ShardedFileCacheBackend(FileCacheBackend):
+    """This file cache backend stores files in the subdirectory 'cache_directory'
+    of the cache root, in subdirectories named by the hash of their keys (i.e.
+    'geraldo-cache/3f/a2/<hash_key>'), so no directory gets too many files.
+    Files older than 'timeout' seconds (if informed) are not used, and when the
+    total size of files exceeds 'max_bytes' (if informed) the oldest ones are
+    removed. Just files with names and paths made by this backend are removed.
+    Sizes and ages are kept in an index shared in the process, listed again
+    from the disk after 'index_timeout' seconds, as other processes can write
+    in the same directory."""
+
+    cache_directory = 'geraldo-cache'
+    shard_levels = 2
+    shard_width = 2
+    max_bytes = None
+    timeout = None
+    index_timeout = 60
+
+    def __init__(self, cache_file_root=None, max_bytes=None, timeout=None, **kwargs):
+        super(ShardedFileCacheBackend, self).__init__(cache_file_root)
+
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+
+        if timeout is not None:
+            self.timeout = timeout
+
+        # Eviction is not allowed in the directory shared by the whole system
+        root = os.path.abspath(self.cache_file_root)
+        if (self.max_bytes is not None or self.timeout is not None) and\
+           root in (os.path.abspath(CACHE_FILE_ROOT), os.path.abspath(tempfile.gettempdir())):
+            raise CacheConfigurationError('Inform a cache_file_root other than "%s" to use '
+                    'max_bytes or timeout'%self.cache_file_root)
+
+        root = os.path.join(root, self.cache_directory)
+        with _file_indexes_lock:
+            try:
+                self.index = _file_indexes[root]
+            except KeyError:
+                self.index = _file_indexes[root] = FileCacheIndex()
+
+    def get_path(self, hash_key):
+        digest = hashlib.sha1(hash_key.encode('utf-8')).hexdigest()
+        width = self.shard_width
+        shards = [digest[num * width:(num + 1) * width] for num in range(self.shard_levels)]
+
+        return os.path.join(self.cache_file_root, self.cache_directory, *(shards + [hash_key]))
+
+    def get_cache_paths(self):
+        """Returns the paths of the files stored by this backend, found just in
+        the shard subdirectories and with names stored in their own paths"""
+        directories = [os.path.join(self.cache_file_root, self.cache_directory)]
+        shard_name = re.compile('^[0-9a-f]{%d}$'%self.shard_width)
+
+        for level in range(self.shard_levels):
+            subdirectories = []
+
+            for directory in directories:
+                try:
+                    names = os.listdir(directory)
+                except OSError:
+                    continue
+
+                subdirectories.extend([os.path.join(directory, name) for name in names
+                    if shard_name.match(name) and os.path.isdir(os.path.join(directory, name))])
+
+            directories = subdirectories
+
+        paths = []
+        for directory in directories:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+
+            for name in names:
+                path = os.path.join(directory, name)
+                if not name.startswith(TEMP_FILE_PREFIX) and self.get_path(name) == path and\
+                   os.path.isfile(path):
+                    paths.append(path)
+
+        return paths
+
+    def is_expired(self, mtime):
+        return self.timeout is not None and mtime + self.timeout <= time.time()
+
+    def remove_path(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+        self.index.discard(path)
+
+    def open_file(self, hash_key):
+        fp = super(ShardedFileCacheBackend, self).open_file(hash_key)
+
+        if fp is not None and self.is_expired(os.fstat(fp.fileno()).st_mtime):
+            fp.close()
+
+            with self.index.lock:
+                self.remove_path(self.get_path(hash_key))
+
+            return None
+
+        return fp
+
+    def exists(self, hash_key):
+        path = self.get_path(hash_key)
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+
+        if self.is_expired(mtime):
+            with self.index.lock:
+                self.remove_path(path)
+
+            return False
+
+        return True
+
+    def write_file(self, hash_key, write):
+        path = super(ShardedFileCacheBackend, self).write_file(hash_key, write)
+
+        if self.max_bytes is not None or self.timeout is not None:
+            stat = os.stat(path)
+
+            with self.index.lock:
+                self.index.add(path, stat.st_size, stat.st_mtime)
+                self.evict()
+
+        return path
+
+    def evict(self):
+        """Removes expired files and the oldest ones while the total size exceeds
+        'max_bytes'. Must be called with the index locked."""
+        index = self.index
+
+        if index.scanned is None or index.scanned + self.index_timeout <= time.time():
+            index.scan(self.get_cache_paths())
+
+        if self.timeout is not None:
+            for path, (size, mtime) in list(index.files.items()):
+                if self.is_expired(mtime):
+                    self.remove_path(path)
+
+        if self.max_bytes is not None and index.size > self.max_bytes:
+            oldest = sorted(list(index.files.items()), key=lambda item: item[1][1])
+
+            for path, (size, mtime) in oldest:
+                if index.size <= self.max_bytes:
+                    break
+
+                self.remove_path(path)
+
+MemoryCacheStats = collections.namedtuple('MemoryCacheStats',
+        'hits misses evictions expirations items size')
+
+class MemoryCacheStore(object):
+    """Contents stored by memory cache backends of the same class and limits,
+    from the least to the most recently used, with their expiring times"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def remove(self, hash_key):
+        content, expires = self.items.pop(hash_key)
+        self.size -= len(content)
+
+_memory_stores = {}
+_memory_stores_lock = threading.Lock()
+
+class MemoryCacheBackend(BaseCacheBackend):
+    """This cache backend stores reports in memory, shared by all instances of
+    the same class and limits in the process (so subclass it or inform other
+    limits to have separated stores). The least recently used reports are
+    discarded when their total size exceeds 'max_bytes', and they expire after
+    'timeout' seconds, if informed. It is thread safe."""
+
+    max_bytes = 64 * 1024 * 1024
+    timeout = None
+
+    def __init__(self, max_bytes=None, timeout=None, **kwargs):
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+
+        if timeout is not None:
+            self.timeout = timeout
+
+        # Instances with different limits don't evict from the same store
+        key = (self.__class__, self.max_bytes, self.timeout)
+
+        with _memory_stores_lock:
+            try:
+                self.store = _memory_stores[key]
+            except KeyError:
+                self.store = _memory_stores[key] = MemoryCacheStore()
+
+    def _get_item(self, hash_key):
+        """Returns the stored item, removing it if expired. Must be called with
+        the store locked."""
+        store = self.store
+        item = store.items.get(hash_key, None)
+
+        if item is not None and item[1] is not None and item[1] <= time.time():
+            store.remove(hash_key)
+            store.expirations += 1
+            item = None
+
+        return item
+
+    def get(self, hash_key):
+        store = self.store
+
+        with store.lock:
+            item = self._get_item(hash_key)
+
+            if item is None:
+                store.misses += 1
+                return None
+
+            store.items.move_to_end(hash_key)
+            store.hits += 1
+
+            return item[0]
+
+    def set(self, hash_key, content):
+        store = self.store
+        expires = self.timeout is not None and time.time() + self.timeout or None
+
+        with store.lock:
+            if hash_key in store.items:
+                store.remove(hash_key)
+
+            # Contents bigger than the whole budget are not stored
+            if len(content) > self.max_bytes:
+                return
+
+            store.items[hash_key] = (content, expires)
+            store.size += len(content)
+
+            # Discards the least recently used contents
+            while store.size > self.max_bytes:
+                store.remove(next(iter(store.items)))
+                store.evictions += 1
 
     def exists(self, hash_key):
-        return os.path.exists(os.path.join(self.cache_file_root, hash_key))
+        with self.store.lock:
+            return self._get_item(hash_key) is not None
+
+    def stats(self):
+        """Returns the counters of hits, misses, evictions and expirations, the
+        number of stored contents and their total size"""
+        store = self.store
+
+        with store.lock:
+            return MemoryCacheStats(store.hits, store.misses, store.evictions,
+                    store.expirations, len(store.items), store.size)
+
+    def clear(self):
+        store = self.store
+
+        with store.lock:
+            store.items.clear()
+            store.size = 0
 
-@memoize
 def get_report_cache_attributes(report):
     from .widgets import ObjectValue
 
@@ -74,7 +457,8 @@ def get_report_cache_attributes(report):
     # Find grouppers attributes
     groups = [group.attribute_name for group in report.groups]
 
-    return list(set(widgets + groups))
+    # Sorted to be the same in every process (sets order depends on hashing)
+    return sorted(set([attr for attr in widgets + groups if attr]))
 
 try:
     # Python 2.5 or higher
@@ -84,6 +468,97 @@ except ImportError:
     import sha
     hash_constructor = sha.new
 
+# Number of encoded values to join before updating the hash object
+HASH_CHUNK_LENGTH = 10000
+
+def _tagged(tag, text):
+    data = text.encode('utf-8', 'surrogatepass')
+    return b'%s%d:%s'%(tag, len(data), data)
+
+def _sorted_members(tag, members):
+    members = sorted(members)
+    return b'%s%d:%s'%(tag, len(members), b''.join(members))
+
+_canonical_encoders = {
+    type(None): lambda value: b'N0:',
+    bool: lambda value: _tagged(b'B', value and '1' or '0'),
+    int: lambda value: _tagged(b'I', str(value)),
+    float: lambda value: _tagged(b'F', repr(value)),
+    decimal.Decimal: lambda value: _tagged(b'D', str(value)),
+    str: lambda value: _tagged(b'S', value),
+    bytes: lambda value: b'Y%d:%s'%(len(value), value),
+    datetime.datetime: lambda value: _tagged(b'T', value.isoformat()),
+    datetime.date: lambda value: _tagged(b'A', value.isoformat()),
+    datetime.time: lambda value: _tagged(b'H', value.isoformat()),
+    tuple: lambda value: b'L%d:%s'%(len(value), b''.join(map(canonical_bytes, value))),
+    list: lambda value: b'L%d:%s'%(len(value), b''.join(map(canonical_bytes, value))),
+    set: lambda value: _sorted_members(b'E', map(canonical_bytes, value)),
+    frozenset: lambda value: _sorted_members(b'E', map(canonical_bytes, value)),
+    dict: lambda value: _sorted_members(b'M', [canonical_bytes(key) + canonical_bytes(item)
+        for key, item in value.items()]),
+    }
+
+def canonical_bytes(value):
+    """Returns the bytes representing a value to make hash keys. They are tagged
+    by the value type and prefixed by the length, so different types or
+    sequences of values never get the same bytes. Members of sets and items of
+    dictionaries are sorted by their bytes, so they don't depend on the hashing
+    order of the process. Other types are represented by their class path and
+    string."""
+    try:
+        encoder = _canonical_encoders[type(value)]
+    except KeyError:
+        cls = type(value)
+        return _tagged(b'O', '%s.%s:%s'%(cls.__module__, cls.__name__, value))
+
+    return encoder(value)
+
+class DataFingerprint(tuple):
+    """Values identifying the state of a data source (i.e. its version, count
+    of rows and latest update time), used instead of its objects to make the
+    hash key of a report cached by queryset"""
+
+def is_django_queryset(queryset):
+    return callable(getattr(queryset, 'aggregate', None)) and hasattr(queryset, 'query')
+
+def get_django_queryset_fingerprint(queryset, updated_field):
+    """Returns the fingerprint of a Django QuerySet, got by a single aggregate
+    query: its SQL, the count of rows and the latest value of the updated field"""
+    from django.db.models import Count, Max
+
+    values = queryset.order_by().aggregate(
+            geraldo_count=Count('pk'),
+            geraldo_updated=Max(updated_field),
+            )
+
+    return (str(queryset.query), values['geraldo_count'], values['geraldo_updated'])
+
+def get_data_fingerprint(report):
+    """Returns the fingerprint of the report queryset, or None if it is not
+    available. It comes from (by this order):
+
+    - the report method 'get_cache_fingerprint';
+    - the queryset method 'cache_fingerprint';
+    - a Django QuerySet, if the report has the attribute 'cache_fingerprint_field'
+      with the field name of the objects updating time."""
+    queryset = report.queryset
+
+    if hasattr(report, 'get_cache_fingerprint'):
+        fingerprint = report.get_cache_fingerprint()
+    elif hasattr(queryset, 'cache_fingerprint'):
+        fingerprint = queryset.cache_fingerprint()
+    elif getattr(report, 'cache_fingerprint_field', None) and is_django_queryset(queryset):
+        fingerprint = get_django_queryset_fingerprint(queryset, report.cache_fingerprint_field)
+    else:
+        fingerprint = None
+
+    if fingerprint is None:
+        return None
+    elif not isinstance(fingerprint, (tuple, list)):
+        fingerprint = (fingerprint,)
+
+    return DataFingerprint(fingerprint)
+
 def make_hash_key(report, objects_list):
     """This function make a hash key from a list of objects.
     
@@ -104,12 +579,24 @@ def make_hash_key(report, objects_list):
     If the method above does't exists, then all attributes explicitly found in report
     elements will be used.
     
-    The result list will be transformed to a long concatenated string and a hash key
-    will be generated from it."""
+    The values are encoded by 'canonical_bytes' and given to the hash object in
+    chunks as the objects are read, so the objects list is never transformed to
+    a long string.
+
+    Situation 3
+    -----------
+
+    If a DataFingerprint is informed instead of the objects list, just its values
+    are used."""
 
     global get_report_cache_attributes
 
-    result = []
+    m = hash_constructor()
+    chunk = []
+
+    if isinstance(objects_list, DataFingerprint):
+        m.update(b'fingerprint:' + canonical_bytes(tuple(objects_list)))
+        return '%s-%s'%(report.cache_prefix, m.hexdigest())
 
     # Get attributes for cache from report
     if hasattr(report, 'get_cache_relevant_attributes'):
@@ -117,18 +604,26 @@ def make_hash_key(report, objects_list):
     else:
         report_attrs = lambda: get_report_cache_attributes(report)
 
+    accessors = None
     for obj in objects_list:
         # Situation 1 - mostly report pages and geraldo objects
         if hasattr(obj, 'repr_for_cache_hash_key'):
-            result.append(obj.repr_for_cache_hash_key())
+            chunk.append(canonical_bytes(obj.repr_for_cache_hash_key()))
 
         # Situation 2 - mostly queryset objects list
         else:
-            result.append('/'.join([str(get_attr_value(obj, attr)) for attr in report_attrs()]))
+            if accessors is None:
+                accessors = [get_attr_accessor(attr) for attr in report_attrs()]
+            chunk.extend([canonical_bytes(accessor(obj)) for accessor in accessors])
+
+        chunk.append(b'\n')
+
+        if len(chunk) >= HASH_CHUNK_LENGTH:
+            m.update(b''.join(chunk))
+            chunk = []
 
     # Makes the hash key
-    m = hash_constructor()
-    m.update('\n'.join(result))
+    m.update(b''.join(chunk))
 
     return '%s-%s'%(report.cache_prefix, m.hexdigest())
 
@@ -6,8 +6,20 @@ except:
     from sets import Set as set
 
 import random, decimal
-from .utils import get_attr_value, memoize
+from functools import cmp_to_key
+from .utils import get_attr_accessor, memoize
 from .base import ReportBand, GeraldoObject, CROSS_COLS, CROSS_ROWS
+from .exceptions import AggregationNotAvailable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Aggregations made with NumPy by matrix(), summarize_rows() and summarize_cols().
+# Averages and sums of floats are made by Python, as NumPy adds floats in another
+# order and results would differ in their latest digits.
+VECTORIZED_FUNCTIONS = ('sum', 'max', 'min', 'count')
 
 RANDOM_ROW_DEFAULT = RANDOM_COL_DEFAULT = ''.join([random.choice([chr(c) for c in range(48, 120)]) for i in range(100)])
 
@@ -44,6 +56,7 @@ class CrossReferenceMatrix(object):
     cols_attr = None
     cols_values = None
     decimal_as_float = False
+    use_numpy = True
 
     def __init__(self, objects_list, rows_attribute, cols_attribute, decimal_as_float=None,
             rows_values=None, cols_values=None):
@@ -52,6 +65,10 @@ class CrossReferenceMatrix(object):
         self.cols_attr = cols_attribute
         self.rows_values = rows_values
         self.cols_values = cols_values
+        self._keys = None
+        self._indexes = {}
+        self._codes = None
+        self._arrays = {}
 
         if decimal_as_float is not None:
             self.decimal_as_float = decimal_as_float
@@ -63,7 +80,7 @@ class CrossReferenceMatrix(object):
     def get_attr_value(self, obj, attr):
         """Returns the attribute value on an object, and converts decimal to float if necessary."""
 
-        value = get_attr_value(obj, attr)
+        value = get_attr_accessor(attr)(obj)
         
         if isinstance(value, decimal.Decimal) and self.decimal_as_float:
             value = float(value)
@@ -71,38 +88,187 @@ class CrossReferenceMatrix(object):
         return value
 
     def sort_rows(self, a, b):
-        return cmp(a, b)
+        return (a > b) - (a < b)
 
     def sort_cols(self, a, b):
-        return cmp(a, b)
+        return (a > b) - (a < b)
+
+    def get_keys(self):
+        """Returns the row and col values of each object, read in a single pass"""
+        if self._keys is None:
+            self._keys = [(self.get_attr_value(obj, self.rows_attr), self.get_attr_value(obj, self.cols_attr))
+                    for obj in self.objects_list]
+
+        return self._keys
+
+    def get_index(self, cell):
+        """Returns the values of a cell attribute indexed by (row, col), by row, by
+        col and all of them, made in a single pass on the objects list. Values
+        keep the objects list order."""
+        try:
+            return self._indexes[cell]
+        except KeyError:
+            pass
+
+        by_cell, by_row, by_col, all_values = {}, {}, {}, []
+
+        for obj, key in zip(self.objects_list, self.get_keys()):
+            value = self.get_attr_value(obj, cell)
+
+            by_cell.setdefault(key, []).append(value)
+            by_row.setdefault(key[0], []).append(value)
+            by_col.setdefault(key[1], []).append(value)
+            all_values.append(value)
+
+        index = self._indexes[cell] = (by_cell, by_row, by_col, all_values)
+        return index
+
+    def get_codes(self):
+        """Returns NumPy arrays with the positions of each object's row in rows()
+        and col in cols() (-1 for values out of them)"""
+        if self._codes is None:
+            keys = self.get_keys()
+            rows_positions = dict([(row, num) for num, row in enumerate(self.rows())])
+            cols_positions = dict([(col, num) for num, col in enumerate(self.cols())])
+
+            self._codes = (
+                numpy.fromiter([rows_positions.get(row, -1) for row, col in keys], numpy.intp, len(keys)),
+                numpy.fromiter([cols_positions.get(col, -1) for row, col in keys], numpy.intp, len(keys)),
+                )
+
+        return self._codes
+
+    def get_cell_array(self, cell):
+        """Returns the values of a cell attribute as a NumPy array, or None if they
+        are not all integers or all floats (mixed values are aggregated by Python,
+        as the array would turn integers to floats)"""
+        try:
+            return self._arrays[cell]
+        except KeyError:
+            pass
+
+        # Values are read from the index if it exists, but it isn't made to this
+        if cell in self._indexes:
+            values = self._indexes[cell][3]
+        else:
+            values = [self.get_attr_value(obj, cell) for obj in self.objects_list]
+
+        types = set(map(type, values))
+        if types == set([int]) or types == set([float]):
+            array = numpy.asarray(values)
+        else:
+            array = None
+
+        # Integers out of int64 range are kept as objects
+        if array is not None and array.dtype.kind not in 'iuf':
+            array = None
+
+        self._arrays[cell] = array
+        return array
+
+    def can_vectorize(self, cell, func):
+        """Returns True if the aggregation can be made with NumPy for the whole
+        matrix or summaries"""
+        if not self.use_numpy or numpy is None or func not in VECTORIZED_FUNCTIONS:
+            return False
+        elif func == 'count':
+            return True
+
+        array = self.get_cell_array(cell)
+        if array is None:
+            return False
+
+        # Sums of integers are made with NumPy just if they can't overflow int64
+        if func == 'sum':
+            if array.dtype.kind not in 'iu':
+                return False
+            elif len(array):
+                bound = max(abs(int(array.max())), abs(int(array.min())))
+                return bound * len(array) <= numpy.iinfo(numpy.int64).max
+
+        # NaN is propagated by NumPy, but not always by Python's max and min
+        elif array.dtype.kind == 'f' and numpy.isnan(array).any():
+            return False
+
+        return True
+
+    def reduce_groups(self, cell, func, groups, groups_count):
+        """Aggregates the cell values by their group codes (negative ones are
+        ignored) with grouped NumPy reductions. Returns a list with the result for
+        each group, the same the aggregation method would return."""
+        valid = groups >= 0
+        groups = groups[valid]
+
+        if func == 'count':
+            return numpy.bincount(groups, minlength=groups_count).tolist()
+
+        values = self.get_cell_array(cell)[valid]
+
+        # Sorts values by group (keeping their order) to reduce each slice
+        order = numpy.argsort(groups, kind='stable')
+        groups, values = groups[order], values[order]
+        starts = numpy.flatnonzero(numpy.diff(groups, prepend=-1))
+
+        # Sum of no values is zero, other aggregations return None
+        if func == 'sum':
+            ret = [0] * groups_count
+        else:
+            ret = [None] * groups_count
+
+        if len(starts):
+            ufunc = {'max': numpy.maximum, 'min': numpy.minimum}.get(func, numpy.add)
+            reduced = ufunc.reduceat(values, starts).tolist()
+
+            for group, value in zip(groups[starts].tolist(), reduced):
+                if func != 'sum':
+                    value = value or None
+
+                ret[group] = value
+
+        return ret
+
+    def vectorized_matrix(self, cell, func):
+        """Returns the rows of the matrix() cells, aggregated with NumPy"""
+        rows_codes, cols_codes = self.get_codes()
+        rows_count, cols_count = len(self.rows()), len(self.cols())
+
+        groups = numpy.where((rows_codes >= 0) & (cols_codes >= 0), rows_codes * cols_count + cols_codes, -1)
+        cells = self.reduce_groups(cell, func, groups, rows_count * cols_count)
+
+        return [cells[num * cols_count:(num + 1) * cols_count] for num in range(rows_count)]
 
     @memoize
     def rows(self):
         if self.rows_values is None:
-            self.rows_values = list(set([self.get_attr_value(obj, self.rows_attr) for obj in self.objects_list]))
+            self.rows_values = list(set([row for row, col in self.get_keys()]))
 
             # Sort list by method
-            self.rows_values.sort(self.sort_rows)
+            self.rows_values.sort(key=cmp_to_key(self.sort_rows))
 
         return self.rows_values
 
     @memoize
     def cols(self):
         if self.cols_values is None:
-            self.cols_values = list(set([self.get_attr_value(obj, self.cols_attr) for obj in self.objects_list]))
+            self.cols_values = list(set([col for row, col in self.get_keys()]))
 
             # Sort list by method
-            self.cols_values.sort(self.sort_cols)
+            self.cols_values.sort(key=cmp_to_key(self.sort_cols))
 
         return self.cols_values
 
-    @memoize
     def values(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
         """Receives the cell, row and col values and make the cross reference among them."""
+        by_cell, by_row, by_col, all_values = self.get_index(cell)
 
-        return [self.get_attr_value(obj, cell) for obj in self.objects_list
-            if (row == RANDOM_ROW_DEFAULT or self.get_attr_value(obj, self.rows_attr) == row) and
-               (col == RANDOM_COL_DEFAULT or self.get_attr_value(obj, self.cols_attr) == col)]
+        if row == RANDOM_ROW_DEFAULT and col == RANDOM_COL_DEFAULT:
+            return all_values
+        elif col == RANDOM_COL_DEFAULT:
+            return by_row.get(row, [])
+        elif row == RANDOM_ROW_DEFAULT:
+            return by_col.get(col, [])
+
+        return by_cell.get((row, col), [])
 
     @memoize
     def max(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
@@ -118,20 +284,21 @@ class CrossReferenceMatrix(object):
     def sum(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
         return sum(self.values(cell, row, col))
 
-    @memoize
-    def avg(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
-        values = list(map(float, self.values(cell, row, col)))
-
+    def get_avg_count(self, values_count, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        """Returns the number the sum of values is divided by to get the average"""
         if row == RANDOM_ROW_DEFAULT and col == RANDOM_COL_DEFAULT:
-            count = len(values)
+            return values_count
         elif row == RANDOM_ROW_DEFAULT:
-            count = len(self.rows())
+            return len(self.rows())
         elif col == RANDOM_COL_DEFAULT:
-            count = len(self.cols())
+            return len(self.cols())
         else:
-            count = len(self.rows()) * len(self.cols())
+            return len(self.rows()) * len(self.cols())
 
-        return values and sum(values) / count or None
+    @memoize
+    def avg(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        values = list(map(float, self.values(cell, row, col)))
+        return values and sum(values) / self.get_avg_count(len(values), row, col) or None
 
     @memoize
     def count(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
@@ -172,12 +339,16 @@ class CrossReferenceMatrix(object):
 
             ret.append(prep + self.cols())
 
-        func = getattr(self, func)
+        if self.can_vectorize(cell, func):
+            cells = self.vectorized_matrix(cell, func)
+        else:
+            func = getattr(self, func)
+            cells = [[func(cell, row, col) for col in self.cols()] for row in self.rows()]
 
-        for row in self.rows():
+        for row, row_cells in zip(self.rows(), cells):
             # Show rows values if argument requires
             prep = show_rows and [row] or []
-            ret.append(prep + [func(cell, row, col) for col in self.cols()])
+            ret.append(prep + row_cells)
 
         return ret
 
@@ -185,11 +356,13 @@ class CrossReferenceMatrix(object):
     def summarize_rows(self, cell, func='values', show_rows=False):
         ret = []
 
-        func = getattr(self, func)
-
-        for row in self.rows():
-            val = func(cell, row)
+        if self.can_vectorize(cell, func):
+            vals = self.reduce_groups(cell, func, self.get_codes()[0], len(self.rows()))
+        else:
+            func = getattr(self, func)
+            vals = [func(cell, row) for row in self.rows()]
 
+        for row, val in zip(self.rows(), vals):
             # Show rows values if argument requires
             if show_rows:
                 ret.append([row, val])
@@ -202,11 +375,13 @@ class CrossReferenceMatrix(object):
     def summarize_cols(self, cell, func='values', show_cols=False):
         ret = []
 
-        func = getattr(self, func)
-
-        for col in self.cols():
-            val = func(cell, col=col)
+        if self.can_vectorize(cell, func):
+            vals = self.reduce_groups(cell, func, self.get_codes()[1], len(self.cols()))
+        else:
+            func = getattr(self, func)
+            vals = [func(cell, col=col) for col in self.cols()]
 
+        for col, val in zip(self.cols(), vals):
             # Show cols values if argument requires
             if show_cols:
                 ret.append([col, val])
@@ -215,3 +390,177 @@ class CrossReferenceMatrix(object):
 
         return ret
 
+
+
+class CrossReferenceAccumulator(object):
+    """Aggregated values of a cell attribute for a row and col, a row, a col or
+    all of the objects. Just the values the informed actions need are kept."""
+
+    __slots__ = ('actions', 'count', 'sum', 'float_sum', 'max', 'min', 'first', 'last', 'distinct')
+
+    def __init__(self, actions):
+        self.actions = actions
+        self.count = 0
+        self.sum = 0
+        self.float_sum = 0
+        self.max = self.min = self.first = self.last = self.distinct = None
+
+        if 'distinct_count' in actions:
+            self.distinct = set()
+
+    def add(self, value):
+        actions = self.actions
+
+        if not self.count:
+            self.first = self.max = self.min = value
+        else:
+            if 'max' in actions and value > self.max:
+                self.max = value
+            if 'min' in actions and value < self.min:
+                self.min = value
+
+        self.last = value
+        self.count += 1
+
+        if 'sum' in actions:
+            self.sum += value
+
+        if 'avg' in actions:
+            self.float_sum += float(value)
+
+        if self.distinct is not None:
+            self.distinct.add(value)
+
+
+class StreamingCrossReferenceMatrix(CrossReferenceMatrix):
+    """A cross reference matrix that reads the objects (any iterable, like a
+    generator or a queryset iterator) just once and doesn't keep them, but just
+    the aggregations of the informed cells. So the memory it takes depends on the
+    number of rows and cols, not on the number of objects.
+
+    Argument 'cells' is a dictionary with the cell attributes and the list of
+    aggregation actions ('max', 'min', 'sum', 'avg', 'count', 'distinct_count',
+    'percent', 'first' or 'last') to keep for each one of them. The method
+    'values' is not available."""
+
+    cells = None
+
+    def __init__(self, objects_list, rows_attribute, cols_attribute, cells, decimal_as_float=None,
+            rows_values=None, cols_values=None):
+        self.rows_attr = rows_attribute
+        self.cols_attr = cols_attribute
+        self.rows_values = rows_values
+        self.cols_values = cols_values
+        self.cells = {}
+
+        if decimal_as_float is not None:
+            self.decimal_as_float = decimal_as_float
+
+        for cell, actions in cells.items():
+            actions = set(actions)
+
+            # Percent is calculated by sums
+            if 'percent' in actions:
+                actions.add('sum')
+
+            self.cells[cell] = frozenset(actions)
+
+        self.consume(objects_list)
+
+    def consume(self, objects_list):
+        """Reads the objects, aggregating each one in its row and col, its row,
+        its col and in the totals"""
+        rows, cols = set(), set()
+        accumulators = dict([(cell, {}) for cell in self.cells])
+
+        for obj in objects_list:
+            row = self.get_attr_value(obj, self.rows_attr)
+            col = self.get_attr_value(obj, self.cols_attr)
+            rows.add(row)
+            cols.add(col)
+
+            keys = ((row, col), (row, RANDOM_COL_DEFAULT), (RANDOM_ROW_DEFAULT, col),
+                    (RANDOM_ROW_DEFAULT, RANDOM_COL_DEFAULT))
+
+            for cell, cell_accumulators in accumulators.items():
+                value = self.get_attr_value(obj, cell)
+
+                for key in keys:
+                    try:
+                        accumulator = cell_accumulators[key]
+                    except KeyError:
+                        accumulator = cell_accumulators[key] = CrossReferenceAccumulator(self.cells[cell])
+
+                    accumulator.add(value)
+
+        self._accumulators = accumulators
+
+        # Rows and cols are sorted here, as the objects are not kept
+        if self.rows_values is None:
+            self.rows_values = sorted(rows, key=cmp_to_key(self.sort_rows))
+
+        if self.cols_values is None:
+            self.cols_values = sorted(cols, key=cmp_to_key(self.sort_cols))
+
+    def get_accumulator(self, cell, action, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        """Returns the accumulator of a cell for the row and col, or None if there
+        were no objects for them"""
+        if cell not in self.cells or (action != 'count' and action not in self.cells[cell]):
+            raise AggregationNotAvailable('Aggregation "%s" of "%s" was not informed to be kept'%(action, cell))
+
+        return self._accumulators[cell].get((row, col), None)
+
+    def can_vectorize(self, cell, func):
+        return False
+
+    def values(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        raise AggregationNotAvailable('Values are not kept by streaming cross reference matrices')
+
+    def max(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        accumulator = self.get_accumulator(cell, 'max', row, col)
+        return accumulator and accumulator.max or None
+
+    def min(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        accumulator = self.get_accumulator(cell, 'min', row, col)
+        return accumulator and accumulator.min or None
+
+    def sum(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        accumulator = self.get_accumulator(cell, 'sum', row, col)
+        if accumulator is None:
+            return 0
+
+        return accumulator.sum
+
+    def avg(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        accumulator = self.get_accumulator(cell, 'avg', row, col)
+        if accumulator is None:
+            return None
+
+        return accumulator.float_sum / self.get_avg_count(accumulator.count, row, col) or None
+
+    def count(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        accumulator = self.get_accumulator(cell, 'count', row, col)
+        return accumulator and accumulator.count or 0
+
+    def distinct_count(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        accumulator = self.get_accumulator(cell, 'distinct_count', row, col)
+        return accumulator and len(accumulator.distinct) or 0
+
+    def percent(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        self.get_accumulator(cell, 'percent', row, col)
+        total = self.sum(cell)
+        return total and (self.sum(cell, row, col) / total * 100) or None
+
+    def first(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        accumulator = self.get_accumulator(cell, 'first', row, col)
+        if accumulator is None:
+            return None
+
+        return accumulator.first
+
+    def last(self, cell, row=RANDOM_ROW_DEFAULT, col=RANDOM_COL_DEFAULT):
+        accumulator = self.get_accumulator(cell, 'last', row, col)
+        if accumulator is None:
+            return None
+
+        return accumulator.last
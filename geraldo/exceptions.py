@@ -13,6 +13,25 @@ class AttributeNotFound(Exception):
 class NotYetImplemented(Exception):
     pass
 
+class InvalidSizeExpression(Exception):
+    pass
+
+class AggregationNotAvailable(Exception):
+    pass
+
+class CacheConfigurationError(Exception):
+    pass
+
+class QuerysetNotAvailable(Exception):
+    """Exception raised when the objects of the queryset are requested after
+    they were consumed by a streamed rendering"""
+    pass
+
+class StreamingNotAvailable(Exception):
+    """Exception raised when an output can't be generated in chunks with the
+    generator settings"""
+    pass
+
 class AbortEvent(Exception):
     """Exception class used inside event methods to abort that printing/rendering"""
     pass
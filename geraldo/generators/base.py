@@ -1,21 +1,27 @@
 import random, shelve, os
-from decimal import Decimal
 
-from geraldo.utils import get_attr_value, calculate_size, memoize
+from geraldo.utils import get_attr_value, get_attr_accessor, calculate_size, memoize,\
+        LookaheadIterator, SequenceRange, LRUCache
 from geraldo.widgets import Widget, Label, SystemField
 from geraldo.graphics import Graphic, RoundRect, Rect, Line, Circle, Arc,\
         Ellipse, Image
 from geraldo.barcodes import BarCode
 from geraldo.base import GeraldoObject, ManyElements
 from geraldo.cache import CACHE_BY_QUERYSET, CACHE_BY_RENDER, CACHE_DISABLED,\
-        make_hash_key, get_cache_backend
+        make_hash_key, get_cache_backend, get_data_fingerprint
 from geraldo.charts import BaseChart
-from geraldo.exceptions import AbortEvent
-import collections
+from geraldo.aggregations import AggregationEngine
+from geraldo.generators.spool import PageSpool
+from geraldo.generators.layout import BandLayout, ElementLayout, has_events, WIDGET_KINDS,\
+        KIND_SYSTEM_FIELD, KIND_LABEL, KIND_BOX, KIND_FIXED, KIND_CIRCLE, KIND_IMAGE,\
+        KIND_BARCODE, KIND_CHART, KIND_MANY, MICRO_POINTS, to_micro_points
+from geraldo.exceptions import AbortEvent, QuerysetNotAvailable
 
 class ReportPage(GeraldoObject):
     rect = None
     _elements = None
+    _spool = None
+    _spool_position = None
     width = None
     randomic_number = None
 
@@ -25,25 +31,122 @@ class ReportPage(GeraldoObject):
         self.randomic_number = str(random.randint(1, 999999)).zfill(6)
 
     def get_children(self):
-        return self._elements
+        return list(self.elements)
 
     def add_element(self, el):
-        """In future this method can be used to store pages on disk and reduce
-        memory consuming"""
+        """Appends an element, restoring the page from the spool if it was
+        stored there"""
+        if self._spool is not None:
+            self.unspool()
+
         self._elements.append(el)
 
     @property
     def elements(self):
-        """In future this method can be used to restore pages from disk and reduce
-        memory consuming"""
-        for el in self._elements:
+        """Iterates on elements, restoring them from the spool (on disk) if the
+        page was stored there"""
+        if self._spool is not None:
+            elements = self._spool.load(self._spool_position)
+        else:
+            elements = self._elements
+
+        for el in elements:
             yield el
 
+    def spool(self, spool):
+        """Stores the elements in the spool, releasing them from memory. Returns
+        False if they couldn't be stored."""
+        if self._spool is not None or not self._elements:
+            return True
+
+        position = spool.dump(self._elements)
+        if position is None:
+            return False
+
+        self._spool, self._spool_position = spool, position
+        self._elements = []
+        return True
+
+    def is_empty(self):
+        """Returns True if the page has no elements, without restoring them
+        from the spool (empty pages are never spooled)"""
+        return self._spool is None and not self._elements
+
+    def unspool(self):
+        """Restores the elements from the spool to the memory"""
+        self._elements = list(self.elements)
+        self._spool = self._spool_position = None
+
     @memoize
     def repr_for_cache_hash_key(self):
         return '/'.join([el.repr_for_cache_hash_key() for el in self.elements
             if hasattr(el, 'repr_for_cache_hash_key')])
 
+def freeze_style(style):
+    """Returns a hashable copy of a style dictionary"""
+    if not style:
+        return None
+
+    return tuple(sorted(style.items()))
+
+class RenderedWidget(object):
+    """Compact record of a widget rendered on a page, stored instead of a widget
+    clone when the widget has no events and its text is resolved on render.
+
+    It keeps just the values that change by object (text and position) and
+    the ones that could change during rendering. Other attributes are got from
+    the widget template, shared by all of its records. The object is not kept,
+    as the text is already resolved, so pages don't hold the queryset rows."""
+
+    __slots__ = ('template', 'band', 'generator', 'text', 'left', 'top',
+            'width', 'height', 'style', 'font_color', 'truncate_overflow', 'visible')
+
+    instance = None
+
+    def __init__(self, template, widget):
+        self.template = template
+        self.band = widget.band
+        self.generator = widget.generator
+        self.text = widget.text
+        self.left = widget.left
+        self.top = widget.top
+        self.width = widget.width
+        self.height = widget.height
+        self.style = widget.style
+        self.font_color = widget.font_color
+        self.truncate_overflow = widget.truncate_overflow
+        self.visible = widget.visible
+
+    def __getattr__(self, name):
+        if name in RenderedWidget.__slots__:
+            raise AttributeError(name)
+
+        return getattr(self.template, name)
+
+    @property
+    def report(self):
+        return self.generator.report
+
+    @property
+    def rect(self):
+        return {
+            'top': self.top,
+            'left': self.left,
+            'height': self.height,
+            'width': self.width,
+            'right': self.generator.calculate_size(self.left) + self.generator.calculate_size(self.width),
+            'bottom': self.generator.calculate_size(self.top) + self.generator.calculate_size(self.height),
+            }
+
+    def do_before_print(self, generator):
+        pass
+
+    def do_after_print(self, generator):
+        pass
+
+    def repr_for_cache_hash_key(self):
+        return str(dict([(attr, getattr(self, attr)) for attr in self.template._repr_for_cache_attrs]))
+
 class ReportGenerator(GeraldoObject):
     """A report generator is used to generate a report to a specific format."""
 
@@ -51,11 +154,17 @@ class ReportGenerator(GeraldoObject):
     first_page_number = 1
     variables = None
     return_pages = False
+    share_templates = True # Stores compact records of simple widgets on pages, instead of clones
+    pages_in_memory = None # If informed, just this number of latest pages is kept in memory
+                           # and the older ones are stored in a temporary file until generated
+    spool_directory = None
+    aggregations = None
+    paragraph_styles_cache_size = 100 # Paragraph styles kept to be reused
 
     _is_first_page = True
     _is_latest_page = True
-    _current_top_position = 0
-    _current_left_position = 0
+    _top_micro_points = 0       # Cursors, in integer micro-points
+    _left_micro_points = 0
     _current_page_number = 1 # This variable is just used for generating, so, keep in mind it
                              # has't the current number while rendering
     _current_object = None
@@ -68,16 +177,29 @@ class ReportGenerator(GeraldoObject):
     _groups_working_values = None
     _groups_changed = None
     _groups_stack = None
+    _groups_runs = None         # Ranges of objects of the current runs of groups
+    _groups_closed_runs = None  # Ranges of the latest finished runs of groups
+    _objects_list = None        # Report objects, if they are not streamed
+    _band_layouts = None        # Layout plans of bands, by their ids
+    _spool = None               # Temporary storage for closed pages
+    _spooled_pages = 0
+    _page_width = None          # Page raw sizes and calculated width
+    _page_geometry = None       # Page raw sizes and calculated heights
+    _queryset_hash_key = None   # Cache hash key by queryset, got just once (False if
+                                # the report is streamed and has no fingerprint)
 
     # The rendered report has pages, each page is a ReportPage instance
     _rendered_pages = None
     _page_rect = None
 
     def __init__(self, report, first_page_number=1, variables=None, return_pages=False,
-            pages=None, **kwargs):
+            pages=None, pages_in_memory=None, **kwargs):
         """This method should be overrided to receive others arguments"""
         self.report = report
 
+        if pages_in_memory is not None:
+            self.pages_in_memory = pages_in_memory
+
         # Initializes some attributes
         self._rendered_pages = pages or []
         self._current_page_number = len(self._rendered_pages)
@@ -85,6 +207,10 @@ class ReportGenerator(GeraldoObject):
         self._groups_working_values = {}
         self._groups_changed = {}
         self._groups_stack = []
+        self._groups_runs = {}
+        self._groups_closed_runs = {}
+        self._paragraph_styles = LRUCache(self.paragraph_styles_cache_size)
+        self._band_layouts = {}
 
         self.first_page_number = first_page_number
         self.variables = variables or self.variables or {}
@@ -179,8 +305,18 @@ class ReportGenerator(GeraldoObject):
                 }
         return band_rect
  
-    def make_widget_rect(self, widget, band_rect):
+    def make_widget_rect(self, widget, band_rect, sizes=None):
         """Returns the right widget rect on the PDF canvas"""
+        if sizes:
+            return {
+                'left': band_rect['left'] + sizes['left'],
+                'top': band_rect['top'] - sizes['top'],
+                'right': band_rect['left'] + sizes['left'] + sizes['width'],
+                'bottom': band_rect['top'] - sizes['top'] + sizes['height'],
+                'height': sizes['height'],
+                'width': sizes['width'],
+                }
+
         widget_rect = {
                 'left': band_rect['left'] + calculate_size(widget.left),
                 'top': band_rect['top'] - calculate_size(widget.top),
@@ -191,68 +327,142 @@ class ReportGenerator(GeraldoObject):
                 }
         return widget_rect
 
+    def get_band_layout(self, band):
+        """Returns the layout plan of a band, making it on the first use or if
+        its elements changed"""
+        layout = self._band_layouts.get(id(band), None)
+
+        if layout is None or layout.band is not band or not layout.is_valid():
+            layout = self._band_layouts[id(band)] = BandLayout(band)
+
+        return layout
+
+    def _get_current_top_position(self):
+        return self._top_micro_points / MICRO_POINTS
+
+    def _set_current_top_position(self, value):
+        self._top_micro_points = to_micro_points(value)
+
+    _current_top_position = property(_get_current_top_position, _set_current_top_position)
+
+    def _get_current_left_position(self):
+        return self._left_micro_points / MICRO_POINTS
+
+    def _set_current_left_position(self, value):
+        self._left_micro_points = to_micro_points(value)
+
+    _current_left_position = property(_get_current_left_position, _set_current_left_position)
+
+    def get_page_geometry(self):
+        """Returns the calculated page height, top and bottom margins, page header
+        and footer heights and the client height (in micro-points), calculated
+        again only if the raw values change"""
+        report = self.report
+        raw = (report.page_size[1], report.margin_top, report.margin_bottom,
+                getattr(report.band_page_header, 'height', 0),
+                getattr(report.band_page_footer, 'height', 0))
+
+        if not self._page_geometry or self._page_geometry[0] != raw:
+            page_height, margin_top, margin_bottom, header_height, footer_height =\
+                    [self.calculate_size(value) for value in raw]
+            client_height = page_height - margin_bottom - margin_top - header_height - footer_height
+
+            self._page_geometry = (raw, (page_height, margin_top, margin_bottom, header_height,
+                footer_height, to_micro_points(client_height)))
+
+        return self._page_geometry[1]
+
+    def get_page_width(self):
+        """Returns the page width without margins, calculated again only if the
+        report page size or margins change"""
+        raw = (self.report.page_size[0], self.report.margin_left, self.report.margin_right)
+
+        if not self._page_width or self._page_width[0] != raw:
+            self._page_width = (raw, self.calculate_size(raw[0]) - self.calculate_size(raw[1]) -\
+                    self.calculate_size(raw[2]))
+
+        return self._page_width[1]
+
     def render_element(self, element, current_object, band, band_rect, temp_top,
-            top_position):
+            top_position, layout=None, share_templates=False):
         # Doesn't render not visible element
         if not element.visible:
             return
 
+        layout = layout or ElementLayout(element)
+        kind = layout.kind
+
         # Widget element
-        if isinstance(element, Widget):
-            widget = element.clone()
+        if kind in WIDGET_KINDS:
+            # Widgets without events and with text resolved on render share a
+            # working widget, and just a compact record is stored on the page
+            shared = share_templates and layout.shareable
+            if shared:
+                widget = layout.get_working_widget(self, band)
+            else:
+                widget = element.clone()
 
-            # Set widget colors
-            widget.font_color = self.report.default_font_color
+                # Set widget colors
+                widget.font_color = self.report.default_font_color
+
+                # Set widget basic attributes
+                widget.generator = self
+                widget.report = self.report # This should be done by a metaclass in Band domain TODO
+                widget.band = band # This should be done by a metaclass in Band domain TODO
 
-            # Set widget basic attributes
             widget.instance = current_object
-            widget.generator = self
-            widget.report = self.report # This should be done by a metaclass in Band domain TODO
-            widget.band = band # This should be done by a metaclass in Band domain TODO
             widget.page = self._rendered_pages[-1]
 
-            # Border rect
-            widget_rect = self.make_widget_rect(widget, band_rect)
+            sizes = layout.get_sizes(self, widget)
 
-            if isinstance(widget, SystemField):
-                widget.left = band_rect['left'] + self.calculate_size(widget.left)
-                widget.top = self.calculate_top(temp_top, self.calculate_size(widget.top))
+            # Border rect
+            widget_rect = self.make_widget_rect(widget, band_rect, layout.get_rect_sizes())
 
-                temp_height = self.calculate_size(element.top) + self.calculate_size(widget.height)
-            elif isinstance(widget, Label):
-                para = self.make_paragraph(widget.text, self.make_paragraph_style(band, widget.style))
+            if kind == KIND_SYSTEM_FIELD:
+                widget.left = band_rect['left'] + sizes['left']
+                widget.top = self.calculate_top(temp_top, sizes['top'])
 
+                temp_height = sizes['top'] + sizes['height']
+            elif kind == KIND_LABEL:
                 if widget.truncate_overflow:
+                    para = self.make_paragraph(widget.text, self.make_paragraph_style(band, widget.style))
                     self.keep_in_frame(
                             widget,
-                            self.calculate_size(widget.width),
-                            self.calculate_size(widget.height),
+                            sizes['width'],
+                            sizes['height'],
                             [para],
                             mode='truncate',
                             )
 
-                    widget.left = band_rect['left'] + self.calculate_size(widget.left)
-                    widget.top = self.calculate_top(temp_top, self.calculate_size(widget.top), self.calculate_size(widget.height))
+                    widget.left = band_rect['left'] + sizes['left']
+                    widget.top = self.calculate_top(temp_top, sizes['top'], sizes['height'])
+
+                    text_height = self.calculate_size(para.height)
                 else:
-                    self.wrap_paragraph_on(para, self.calculate_size(widget.width), self.calculate_size(widget.height))
-                    widget.left = band_rect['left'] + self.calculate_size(widget.left)
-                    widget.top = self.calculate_top(temp_top, self.calculate_size(widget.top), self.calculate_size(para.height))
+                    text_height = self.calculate_size(self.get_text_height(widget.text, band,
+                        widget.style, sizes['width'], sizes['height']))
+                    widget.left = band_rect['left'] + sizes['left']
+                    widget.top = self.calculate_top(temp_top, sizes['top'], text_height)
 
-                temp_height = self.calculate_size(element.top) + self.calculate_size(para.height)
+                temp_height = sizes['top'] + text_height
             else:
-                temp_height = self.calculate_size(element.top) + self.calculate_size(widget.height)
+                temp_height = sizes['top'] + sizes['height']
 
             # Sets element height as the highest
             if temp_height > self._highest_height:
                 self._highest_height = temp_height
 
-            self._rendered_pages[-1].add_element(widget)
+            if shared:
+                self._rendered_pages[-1].add_element(RenderedWidget(element, widget))
+                widget.instance = None # The working widget is reused by the next objects
+            else:
+                self._rendered_pages[-1].add_element(widget)
 
             # Borders
             self.render_border(widget.borders or {}, widget_rect)
 
         # Graphic element
-        elif isinstance(element, Graphic):
+        elif kind is not None and kind != KIND_MANY:
             graphic = element.clone()
 
             # Set widget basic attributes
@@ -266,51 +476,40 @@ class ReportGenerator(GeraldoObject):
             graphic.fill_color = graphic.fill_color or self.report.default_fill_color
             graphic.stroke_color = graphic.stroke_color or self.report.default_stroke_color
 
-            if isinstance(graphic, RoundRect):
-                graphic.left = band_rect['left'] + self.calculate_size(graphic.left)
-                graphic.top = top_position - self.calculate_size(graphic.top) - self.calculate_size(graphic.height)
-            elif isinstance(graphic, Rect):
-                graphic.left = band_rect['left'] + self.calculate_size(graphic.left)
-                graphic.top = top_position - self.calculate_size(graphic.top) - self.calculate_size(graphic.height)
-            elif isinstance(graphic, Line):
-                graphic.left = band_rect['left'] + self.calculate_size(graphic.left)
-                graphic.top = top_position - self.calculate_size(graphic.top)
-                graphic.right = band_rect['left'] + self.calculate_size(graphic.right)
-                graphic.bottom = top_position - self.calculate_size(graphic.bottom)
-            elif isinstance(graphic, Circle):
-                graphic.left_center = band_rect['left'] + self.calculate_size(graphic.left_center)
-                graphic.top_center = top_position - self.calculate_size(graphic.top_center)
-            elif isinstance(graphic, Arc):
-                graphic.left = band_rect['left'] + self.calculate_size(graphic.left)
-                graphic.top = top_position - self.calculate_size(graphic.top)
-                graphic.right = band_rect['left'] + self.calculate_size(graphic.right)
-                graphic.bottom = top_position - self.calculate_size(graphic.bottom)
-            elif isinstance(graphic, Ellipse):
-                graphic.left = band_rect['left'] + self.calculate_size(graphic.left)
-                graphic.top = top_position - self.calculate_size(graphic.top)
-                graphic.right = band_rect['left'] + self.calculate_size(graphic.right)
-                graphic.bottom = top_position - self.calculate_size(graphic.bottom)
-            elif isinstance(graphic, Image):
-                graphic.left = band_rect['left'] + self.calculate_size(graphic.left)
-                graphic.top = top_position - self.calculate_size(graphic.top) - self.calculate_size(graphic.height)
-            elif isinstance(graphic, BarCode):
+            sizes = layout.get_sizes(self, graphic)
+
+            if kind == KIND_BOX:
+                graphic.left = band_rect['left'] + sizes['left']
+                graphic.top = top_position - sizes['top'] - sizes['height']
+            elif kind == KIND_FIXED:
+                graphic.left = band_rect['left'] + sizes['left']
+                graphic.top = top_position - sizes['top']
+                graphic.right = band_rect['left'] + sizes['right']
+                graphic.bottom = top_position - sizes['bottom']
+            elif kind == KIND_CIRCLE:
+                graphic.left_center = band_rect['left'] + sizes['left_center']
+                graphic.top_center = top_position - sizes['top_center']
+            elif kind in (KIND_IMAGE, KIND_CHART):
+                graphic.left = band_rect['left'] + sizes['left']
+                graphic.top = top_position - sizes['top'] - self.calculate_size(graphic.height)
+            elif kind == KIND_BARCODE:
                 barcode = graphic.render()
-                graphic.left = band_rect['left'] + self.calculate_size(graphic.left)
-                graphic.top = top_position - self.calculate_size(graphic.top) - self.calculate_size(graphic.height)
+                graphic.left = band_rect['left'] + sizes['left']
+                graphic.top = top_position - sizes['top'] - self.calculate_size(graphic.height)
                 self.wrap_barcode_on(barcode, graphic.width, graphic.height)
-            elif isinstance(element, BaseChart):
-                graphic.left = band_rect['left'] + self.calculate_size(graphic.left)
-                graphic.top = top_position - self.calculate_size(graphic.top) - self.calculate_size(graphic.height)
 
             # Sets element height as the highest
-            temp_height = self.calculate_size(element.top) + self.calculate_size(graphic.height)
+            if 'height' in sizes:
+                temp_height = sizes['top'] + sizes['height']
+            else:
+                temp_height = sizes['top'] + self.calculate_size(graphic.height)
             if temp_height > self._highest_height:
                 self._highest_height = temp_height
 
             self._rendered_pages[-1].add_element(graphic)
 
         # Many elements
-        elif isinstance(element, ManyElements):
+        elif kind == KIND_MANY:
             # Set widget basic attributes
             element.instance = current_object
             element.generator = self
@@ -338,8 +537,7 @@ class ReportGenerator(GeraldoObject):
         current_object = current_object or self._current_object
 
         # Page width. This should be done in a metaclass in Report domain TODO
-        self._rendered_pages[-1].width = self.calculate_size(self.report.page_size[0]) -\
-                self.calculate_size(self.report.margin_left) - self.calculate_size(self.report.margin_right)
+        self._rendered_pages[-1].width = self.get_page_width()
 
         # Default value for band width
         band.width = self.calculate_size(band.width) or self._rendered_pages[-1].width
@@ -368,10 +566,15 @@ class ReportGenerator(GeraldoObject):
         # Variable that stores the highest height at all elements
         self._highest_height = 0
 
-        # Loop at band widgets
-        for element in band.elements:
+        # Templates are shared only if no event can change them while rendering
+        share_templates = self.share_templates and not has_events(band, 'before_print', 'after_print')\
+                and not has_events(self.report, 'on_new_page')
+
+        # Loop at band widgets, with their planned layouts
+        layout = self.get_band_layout(band)
+        for element, element_layout in zip(layout.elements, layout.layouts):
             self.render_element(element, current_object, band, band_rect, temp_top,
-                    top_position)
+                    top_position, element_layout, share_templates)
 
         # Updates top position
         if update_top:
@@ -410,15 +613,38 @@ class ReportGenerator(GeraldoObject):
     def force_blank_page_by_height(self, height):
         """Check if the height is in client available report height and
         makes a new page if necessary"""
-        if Decimal(str(self.get_available_height())) < Decimal(str(height)):
+        if self.get_available_micro_points() < to_micro_points(height):
             self.start_new_page()
             return True
         
         return False
 
     def append_new_page(self):
+        self.spool_closed_pages()
         self._rendered_pages.append(ReportPage())
 
+    def spool_closed_pages(self):
+        """Stores the closed pages out of the in-memory window in the spool"""
+        if not self.pages_in_memory:
+            return
+
+        if self._spool is None:
+            self._spool = PageSpool(self.spool_directory)
+            self._spooled_pages = 0
+
+        # The current page is closed when a new one is appended
+        closed = len(self._rendered_pages) - self.pages_in_memory + 1
+        while self._spooled_pages < closed:
+            self._rendered_pages[self._spooled_pages].spool(self._spool)
+            self._spooled_pages += 1
+
+    def close_spool(self):
+        """Removes the spool after the pages are generated. The spooled pages
+        can't be read anymore."""
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
     def start_new_page(self, with_header=True):
         """Starts a new blank page"""
         # Ends the current page
@@ -527,24 +753,37 @@ class ReportGenerator(GeraldoObject):
         self.update_top_pos(set_position=0) # <---- update top position
  
     def render_bands(self):
-        """Loops into the objects list to create the report pages until the end"""
+        """Loops into the objects list to create the report pages until the end.
+
+        The objects are consumed from an iterator, keeping only the current and
+        the previous ones (the last is used by groups' footers) in memory."""
  
         # Preparing local auxiliar variables
         self._current_page_number = self.report.first_page_number
         self._current_object_index = 0
-        objects = self.report.get_objects_list()
+
+        # The objects list is kept to get the objects of groups by their ranges
+        if self.report.stream_queryset:
+            self._objects_list = None
+            objects = LookaheadIterator(self.report.get_objects_iterator())
+        else:
+            self._objects_list = self.report.get_objects_list()
+            objects = LookaheadIterator(self._objects_list)
+
+        # Registers the aggregated widgets to be calculated while walking on objects
+        self.aggregations = AggregationEngine(self)
 
         # just an alias to make it shorter
         d_band = self.report.band_detail
 
         # Empty report
-        if self.report.print_if_empty and not objects:
+        if self.report.print_if_empty and not objects.has_next():
             self.start_new_page()
             self.render_begin()
             self.render_end_current_page()
 
         # Loop for pages
-        while self._current_object_index < len(objects):
+        while objects.has_next():
             # Starts a new page and generates the page header band
             self.start_new_page()
             first_object_on_page = True
@@ -555,23 +794,34 @@ class ReportGenerator(GeraldoObject):
 
             # Does generate objects if there is no details band
             if not d_band:
-                self._current_object_index = len(objects)
+                for obj in objects:
+                    self._current_object = obj
+                    self.calc_changed_groups(first_object_on_page)
+                    self.aggregations.feed(obj, self._groups_values)
+                    self._current_object_index += 1
+
+                    # Groups' footers are not rendered here to pop the changed
+                    # groups, so the stack is kept with a single entry by group
+                    del self._groups_stack[len(self.report.groups):]
 
             # Loop for objects to go into grid on current page
-            while self._current_object_index < len(objects):
-                # Get current object from list
-                self._current_object = objects[self._current_object_index]
+            while objects.has_next():
+                # Get current object from iterator
+                self._current_object = next(objects)
 
                 # Renders group bands for changed values
                 self.calc_changed_groups(first_object_on_page)
 
+                # Folds the object into aggregations, closing the changed groups
+                self.aggregations.feed(self._current_object, self._groups_values)
+
                 if not first_object_on_page:
                     # The current_object of the groups' footers is the previous 
                     # object, so we have access, in groups' footers, to the last
                     # object before the group breaking
-                    self._current_object = objects[self._current_object_index-1]
+                    self._current_object = objects.previous
                     self.render_groups_footers()
-                    self._current_object = objects[self._current_object_index]
+                    self._current_object = objects.current
 
                 self.render_groups_headers(first_object_on_page)
 
@@ -595,7 +845,7 @@ class ReportGenerator(GeraldoObject):
                 # Break this if this page doesn't suppport nothing more...
                 # ... if there is no more available height
                 if done != False:
-                    if self.get_available_height() < self.calculate_size(d_band.height):
+                    if self.get_available_micro_points() < to_micro_points(self.calculate_size(d_band.height)):
                         # right margin is not considered to calculate the necessary space
                         d_width = self.calculate_size(d_band.width) + self.calculate_size(getattr(d_band, 'margin_left', 0))
 
@@ -604,14 +854,15 @@ class ReportGenerator(GeraldoObject):
                             break
 
                     # ... or this band forces a new page and this is not the last object in objects list
-                    elif d_band.force_new_page and self._current_object_index < len(objects):
+                    elif d_band.force_new_page and objects.has_next():
                         break
 
             # Sets this is the latest page or not
-            self._is_latest_page = self._current_object_index >= len(objects)
+            self._is_latest_page = not objects.has_next()
 
             # Renders the finish group footer bands
             if self._is_latest_page:
+                self.aggregations.finish()
                 self.calc_changed_groups(False)
                 self.render_groups_footers(force=True)
 
@@ -625,6 +876,9 @@ class ReportGenerator(GeraldoObject):
             # Increment page number
             self._current_page_number += 1
 
+        # Releases the latest object, as the rendered pages don't need it
+        self._current_object = None
+
     def calculate_size(self, size):
         """Uses the function 'calculate_size' to calculate a size"""
         return calculate_size(size)
@@ -643,35 +897,28 @@ class ReportGenerator(GeraldoObject):
     def get_top_pos(self):
         """We use this to use this to get the current top position, 
         considering also the top margin."""
-        ret = self.calculate_size(self.report.margin_top) + self._current_top_position
+        page_height, margin_top, margin_bottom, header_height, footer_height, client_height =\
+                self.get_page_geometry()
 
-        if self.report.band_page_header:
-            ret += self.calculate_size(self.report.band_page_header.height)
-
-        return ret
+        return margin_top + self._current_top_position + header_height
 
     def get_available_height(self):
         """Returns the available client height area from the current top position
         until the end of page, considering the bottom margin."""
-        ret = self.calculate_size(self.report.page_size[1]) - self.calculate_size(self.report.margin_bottom) -\
-                self.calculate_size(self.report.margin_top) - self._current_top_position
-
-        if self.report.band_page_header:
-            ret -= self.calculate_size(self.report.band_page_header.height)
+        return self.get_available_micro_points() / MICRO_POINTS
 
-        if self.report.band_page_footer:
-            ret -= self.calculate_size(self.report.band_page_footer.height)
-
-        return ret
+    def get_available_micro_points(self):
+        """Returns the available client height in integer micro-points, used to
+        decide page breaks"""
+        return self.get_page_geometry()[5] - self._top_micro_points
 
     def update_top_pos(self, increase=0, decrease=0, set_position=None):
         """Updates the current top position controller, increasing (by default),
         decreasing or setting it with a new value."""
         if set_position is not None:
-            self._current_top_position = set_position
-        else:        
-            self._current_top_position += increase
-            self._current_top_position -= decrease
+            self._top_micro_points = to_micro_points(set_position)
+        else:
+            self._top_micro_points += to_micro_points(increase) - to_micro_points(decrease)
 
         return self._current_top_position
 
@@ -679,17 +926,17 @@ class ReportGenerator(GeraldoObject):
         """Updates the current left position controller, increasing (by default),
         decreasing or setting it with a new value."""
         if set_position is not None:
-            self._current_left_position = set_position
-        else:        
-            self._current_left_position += increase
-            self._current_left_position -= decrease
+            self._left_micro_points = to_micro_points(set_position)
+        else:
+            self._left_micro_points += to_micro_points(increase) - to_micro_points(decrease)
 
         return self._current_left_position
 
     def get_page_count(self):
         """Calculate and returns the page count for this report. The challenge
-        here is do this calculate before to generate the pages."""
-        return len(self._rendered_pages)
+        here is do this calculate before to generate the pages. Pages with no
+        elements are not generated, so they are not counted."""
+        return len([page for page in self._rendered_pages if not page.is_empty()])
 
     def make_paragraph(self, text, style=None):
         """Uses the Paragraph class to return a new paragraph object"""
@@ -699,6 +946,18 @@ class ReportGenerator(GeraldoObject):
         """Wraps the paragraph on the height/width informed"""
         raise Exception('Not implemented')
 
+    def get_text_height(self, text, band, style, width, height):
+        """Returns the height of a text wrapped on the height/width informed"""
+        return self.make_wrapped_paragraph(text, band, style, width, height).height
+
+    def make_wrapped_paragraph(self, text, band, style, width, height):
+        """Returns a new paragraph, using the band and widget styles, wrapped on
+        the height/width informed"""
+        para = self.make_paragraph(text, self.make_paragraph_style(band, style))
+        self.wrap_paragraph_on(para, width, height)
+
+        return para
+
     def wrap_barcode_on(self, barcode, width, height):
         """Wraps the barcode on the height/width informed"""
         raise Exception('Not implemented')
@@ -729,9 +988,19 @@ class ReportGenerator(GeraldoObject):
 
         # Loops on groups until find the first changed, then all under it are considered
         # changed also
+        really_changed = False
+        key = ()
         for group in self.report.groups:
             # Gets the current value to compare with the old one
-            current_value = get_attr_value(self._current_object, group.attribute_name)
+            current_value = get_attr_accessor(group.attribute_name)(self._current_object)
+            key += (current_value,)
+
+            # A run of objects for this group starts only if its value really
+            # changed, not if it is just forced by a new page
+            really_changed = really_changed or group not in self._groups_runs or\
+                    current_value != self._groups_values.get(group, None)
+            if really_changed:
+                self.start_group_run(group, key)
 
             # Set changed as True if if wasn't and there is a change
             changed = changed or current_value != self._groups_values.get(group, None)
@@ -744,6 +1013,33 @@ class ReportGenerator(GeraldoObject):
             if changed:
                 self._groups_stack.append(group)
 
+    def start_group_run(self, group, key):
+        """Closes the current run of objects of a group (if any) and starts a
+        new one from the current object. A run is a list with its start index,
+        stop index (None while it is not known) and group values."""
+        run = self._groups_runs.get(group, None)
+        if run is not None:
+            run[1] = self._current_object_index
+            self._groups_closed_runs[group] = run
+
+        self._groups_runs[group] = [self._current_object_index, None, key]
+
+    def get_group_run_stop(self, run):
+        """Finds the stop index of a run that is not finished yet, walking on
+        the objects list from the current object while the group values are the
+        same."""
+        accessors = [get_attr_accessor(group.attribute_name) for group in self.report.groups[:len(run[2])]]
+        stop = max(run[0], self._current_object_index)
+
+        while stop < len(self._objects_list):
+            obj = self._objects_list[stop]
+            if tuple([accessor(obj) for accessor in accessors]) != run[2]:
+                break
+            stop += 1
+
+        run[1] = stop
+        return stop
+
     def render_groups_headers(self, first_object_on_page=False):
         """Renders the report headers using 'changed' definition calculated by
         'calc_changed_groups'"""
@@ -788,12 +1084,21 @@ class ReportGenerator(GeraldoObject):
 
     def get_current_queryset(self):
         """Returns the current queryset. This solves a problem with subreports
-        footers and headers, and solves also flexibility and customization issues."""
+        footers and headers, and solves also flexibility and customization issues.
+
+        Raises QuerysetNotAvailable if the report streams its queryset, as the
+        objects are consumed while they are rendered."""
 
         # Customized and SubReports
         if self._current_queryset is not None:
             return self._current_queryset
 
+        # Streamed objects can't be read again
+        elif self.report.stream_queryset:
+            raise QuerysetNotAvailable('The queryset of a report with stream_queryset '
+                    'can\'t be read again. Use aggregations calculated by the generator '
+                    'or set stream_queryset to False.')
+
         # Groups
         elif self._groups_stack:
             return self.get_objects_in_group()
@@ -805,11 +1110,29 @@ class ReportGenerator(GeraldoObject):
         """Returns objects filtered in the current group or all if there is no
         group"""
 
-        filter_dict = dict([(group.attribute_name, value) for group, value in list(self._groups_working_values.items())])
+        # Gets the range of objects from the runs of the group (as objects are
+        # sorted by groups) instead of filtering all of them
+        if self._objects_list is not None and self._groups_working_values:
+            groups = self.report.groups[:len(self._groups_working_values)]
+
+            try:
+                key = tuple([self._groups_working_values[group] for group in groups])
+            except KeyError:
+                key = None
+
+            if key is not None:
+                for run in (self._groups_runs.get(groups[-1], None),
+                            self._groups_closed_runs.get(groups[-1], None)):
+                    if run is not None and run[2] == key:
+                        stop = run[1] if run[1] is not None else self.get_group_run_stop(run)
+                        return SequenceRange(self._objects_list, run[0], stop)
+
+        filter_dict = dict([(get_attr_accessor(group.attribute_name), value)
+            for group, value in list(self._groups_working_values.items())])
 
         def filter_object(obj):
-            for k,v in list(filter_dict.items()):
-                if get_attr_value(obj, k) != v:
+            for accessor,v in list(filter_dict.items()):
+                if accessor(obj) != v:
                     return False
 
             return obj
@@ -827,7 +1150,7 @@ class ReportGenerator(GeraldoObject):
 
         def force_new_page(height):
             # Forces new page if there is no available space
-            if self.get_available_height() < self.calculate_size(height):
+            if self.get_available_micro_points() < to_micro_points(self.calculate_size(height)):
                 self.render_page_footer()
                 self.start_new_page()
 
@@ -874,39 +1197,105 @@ class ReportGenerator(GeraldoObject):
             self._current_queryset = None
 
     def make_paragraph_style(self, band, style=None):
-        """Merge report default_style + band default_style + widget style"""
+        """Merge report default_style + band default_style + widget style. The
+        resulting style is made once for each combination of styles contents
+        and reused by the latest used combinations."""
+        try:
+            key = (freeze_style(self.report.default_style), freeze_style(band.default_style),
+                    freeze_style(style))
+            hash(key)
+        except TypeError: # Unhashable style values
+            return self.make_style_from_dict(self.merge_paragraph_styles(band, style))
+
+        p_style = self._paragraph_styles.get(key)
+        if p_style is None:
+            p_style = self.make_style_from_dict(self.merge_paragraph_styles(band, style))
+            self._paragraph_styles.set(key, p_style)
+
+        return p_style
+
+    def merge_paragraph_styles(self, band, style=None):
+        """Returns a dictionary with report default_style + band default_style +
+        widget style"""
+        d_style = self.report.default_style.copy()
+
+        if band.default_style:
+            for k,v in list(band.default_style.items()):
+                d_style[k] = v
+
+        if style:
+            for k,v in list(style.items()):
+                d_style[k] = v
+
+        return d_style
+
+    def make_style_from_dict(self, d_style):
+        """Returns the style object used by paragraphs from a dictionary"""
         raise Exception('Not implemented')
 
     def keep_in_frame(self, widget, width, height, paragraphs, mode):
         raise Exception('Not implemented')
 
-    def fetch_from_cache(self):
+    def get_cache_hash_key(self):
+        """Returns the hash key to find and store the report in the cache. By
+        queryset, it is calculated just once, from the queryset fingerprint if
+        it is available (see geraldo.cache.get_data_fingerprint) or else from
+        its objects. Returns None for streamed reports with no fingerprint, as
+        reading their objects would consume them (or load all of them)."""
         if self.report.cache_status == CACHE_BY_QUERYSET:
-            hash_key = self.get_hash_key(self.report.queryset)
+            if self._queryset_hash_key is None:
+                fingerprint = get_data_fingerprint(self.report)
+
+                if fingerprint is not None:
+                    self._queryset_hash_key = self.get_hash_key(fingerprint)
+                elif self.report.stream_queryset:
+                    self._queryset_hash_key = False
+                else:
+                    self._queryset_hash_key = self.get_hash_key(self.report.queryset)
+
+            return self._queryset_hash_key or None
         elif self.report.cache_status == CACHE_BY_RENDER:
-            hash_key = self.get_hash_key(self._rendered_pages)
+            return self.get_hash_key(self._rendered_pages)
+
+    def fetch_from_cache(self):
+        hash_key = self.get_cache_hash_key()
 
         cache = self.get_cache_backend()
-        buffer = cache.get(hash_key)
-
-        if buffer:
-            # Write to file stream
-            if hasattr(self.filename, 'write') and isinstance(self.filename.write, collections.Callable):
-                self.filename.write(buffer)
-                return True
-                
-            # Write to file path
-            elif isinstance(self.filename, str):
-                fp = file(self.filename, 'w')
-                fp.write(buffer)
+
+        # Write to file stream
+        if hasattr(self.filename, 'write') and callable(self.filename.write):
+            return cache.copy_to(hash_key, self.filename)
+
+        # Write to file path
+        elif isinstance(self.filename, str) and cache.exists(hash_key):
+            fp = open(self.filename, 'wb')
+            try:
+                found = cache.copy_to(hash_key, fp)
+            finally:
                 fp.close()
-                return True
+
+            if not found:
+                os.remove(self.filename)
+
+            return found
+
+    def uses_cache(self):
+        """Returns True if the cache is enabled and there is a hash key to find
+        and store the report"""
+        if not self.cache_enabled or self.report.cache_status == CACHE_DISABLED:
+            return False
+
+        # Streamed reports are cached by queryset just with a data fingerprint
+        elif self.report.cache_status == CACHE_BY_QUERYSET:
+            return self.get_cache_hash_key() is not None
+
+        return True
 
     def cached_before_render(self):
         """Check and loads the generated report from caching system before call method
         'render_bands'"""
 
-        if not self.cache_enabled or self.report.cache_status != CACHE_BY_QUERYSET:
+        if self.report.cache_status != CACHE_BY_QUERYSET or not self.uses_cache():
             return False
 
         return self.fetch_from_cache()
@@ -915,7 +1304,7 @@ class ReportGenerator(GeraldoObject):
         """Check and loads the generated report from caching system before call method
         'generate_pages'"""
 
-        if not self.cache_enabled or self.report.cache_status != CACHE_BY_RENDER:
+        if self.report.cache_status != CACHE_BY_RENDER or not self.uses_cache():
             return False
 
         return self.fetch_from_cache()
@@ -923,25 +1312,44 @@ class ReportGenerator(GeraldoObject):
     def store_in_cache(self, content):
         """Sends the canvas content to write in the cache backend"""
 
-        if not self.cache_enabled or self.report.cache_status == CACHE_DISABLED:
+        if not self.uses_cache():
             return
 
-        if self.report.cache_status == CACHE_BY_QUERYSET:
-            hash_key = self.get_hash_key(self.report.queryset)
-        elif self.report.cache_status == CACHE_BY_RENDER:
-            hash_key = self.get_hash_key(self._rendered_pages)
+        hash_key = self.get_cache_hash_key()
 
         cache = self.get_cache_backend()
 
         return cache.set(hash_key, content)
 
+    def store_file_in_cache(self, filename):
+        """Sends the content of a generated file to the cache backend, that
+        copies it without reading it at all to memory"""
+
+        if not self.uses_cache():
+            return
+
+        hash_key = self.get_cache_hash_key()
+
+        cache = self.get_cache_backend()
+
+        fp = open(filename, 'rb')
+        try:
+            return cache.store_file(hash_key, fp)
+        finally:
+            fp.close()
+
     def get_hash_key(self, objects):
         """Calculates the hash_key, appending/prepending something if necessary"""
         return make_hash_key(self.report, objects)
 
     def get_cache_backend(self):
-        return get_cache_backend(
-                self.report.cache_backend,
-                cache_file_root=self.report.cache_file_root,
-                )
+        kwargs = {'cache_file_root': self.report.cache_file_root}
+
+        # Limits are informed just if set, as not all backends support them
+        if self.report.cache_max_bytes is not None:
+            kwargs['max_bytes'] = self.report.cache_max_bytes
+        if self.report.cache_timeout is not None:
+            kwargs['timeout'] = self.report.cache_timeout
+
+        return get_cache_backend(self.report.cache_backend, **kwargs)
 
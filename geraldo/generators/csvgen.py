@@ -1,11 +1,13 @@
-import datetime, csv
+import datetime, csv, types, io
 from .base import ReportGenerator
 
-from geraldo.utils import get_attr_value, calculate_size
-from geraldo.widgets import Widget, Label, SystemField, ObjectValue
+from geraldo.base import GeraldoObject, BaseReport
+from geraldo.utils import get_attr_value, get_attr_accessor, calculate_size
+from geraldo.widgets import Widget, Label, SystemField, ObjectValue,\
+        FIELD_ACTION_VALUE, compile_attribute_expression
 from geraldo.graphics import Graphic, RoundRect, Rect, Line, Circle, Arc,\
         Ellipse, Image
-from geraldo.exceptions import AbortEvent
+from geraldo.exceptions import AbortEvent, StreamingNotAvailable
 
 class CSVGenerator(ReportGenerator):
     """This is a generator to output data in CSV format. This format can be imported as a
@@ -16,11 +18,19 @@ class CSVGenerator(ReportGenerator):
         * 'filename' - is the file path you can inform optionally to save text to.
         * 'writer' - is csv.writer function you can inform manually to make it customizable.
                      This function must expects a first argument to receive a file object and
-                     returns a csv.writer object.
+                     returns a csv.writer object. It is not supported by 'generate_chunks',
+                     that uses 'writer_function'.
+        * 'rows_per_write' - is the number of rows sent together to the writer.
+        * 'chunk_size' - is the approximate size of chunks yielded by 'generate_chunks'.
+        * 'encode_to' - is the coding identifier of chunks yielded by 'generate_chunks'.
     """
     writer = None
     writer_function = csv.writer
     first_row_with_column_names = False
+    rows_per_write = 1000
+    chunk_size = 65536
+    encode_to = 'utf-8'
+    _opened_file = None
 
     mimetype = 'text/csv'
 
@@ -51,7 +61,7 @@ class CSVGenerator(ReportGenerator):
         filename = filename or self.filename
 
         if isinstance(filename, str):
-            filename = file(filename, 'w')
+            filename = self._opened_file = open(filename, 'w', newline='')
 
         # Default writer uses comma as separator and quotes only when necessary
         self.writer = self.writer_function(filename, quoting=csv.QUOTE_MINIMAL)
@@ -59,6 +69,8 @@ class CSVGenerator(ReportGenerator):
     def execute(self):
         super(CSVGenerator, self).execute()
 
+        # CSV output is not cached (see 'generate_chunks')
+
         # Calls the before_print event
         self.report.do_before_print(generator=self)
 
@@ -75,46 +87,162 @@ class CSVGenerator(ReportGenerator):
     # METHODS THAT ARE TOTALLY SPECIFIC TO THIS GENERATOR AND MUST
     # OVERRIDE THE SUPERCLASS EQUIVALENT ONES
 
-    def generate_csv(self):
-        """Generates the CSV output"""
+    def uses_default_object_values(self, band):
+        """Returns True if the band and its parents don't customize the method
+        'get_object_value', so widgets get their values by themselves"""
+        while band is not None:
+            method = type(band).get_object_value
 
-        self._current_object_index = 0
-        objects = self.report.get_objects_list()
+            if method is BaseReport.get_object_value:
+                return True
+            elif method is not GeraldoObject.get_object_value:
+                return False
 
-        self.start_writer()
+            band = band.parent
+
+        return True
+
+    def make_column_extractor(self, column):
+        """Returns a function that receives an object and returns the text of the
+        column for it. Simple attribute values are read directly by a compiled
+        accessor and formatted; other columns (with expressions, actions, lambdas
+        or customized object values) use a widget clone as usual."""
+        band = self.report.band_detail
+
+        if type(column) is ObjectValue and column.action == FIELD_ACTION_VALUE and\
+           not column.expression and not column.get_value and not column.get_text and\
+           not compile_attribute_expression(column.attribute_name) and\
+           self.uses_default_object_values(band):
+            accessor = get_attr_accessor(column.attribute_name)
+            display_format = column.display_format
+
+            def extract(obj):
+                value = accessor(obj)
+
+                # Same as ObjectValue.get_object_value does for methods
+                if type(value) == types.MethodType:
+                    value = value()
+
+                return display_format % str(value)
+
+            return extract
 
-        # Make a sorted list of columns
+        def extract(obj):
+            widget = column.clone()
+
+            # Set widget colors
+            widget.font_color = self.report.default_font_color
+
+            # Set widget basic attributes
+            widget.instance = obj
+            widget.generator = self
+            widget.report = self.report
+            widget.band = band
+            widget.page = None
+
+            return widget.text
+
+        return extract
+
+    def make_row_extractor(self, columns):
+        """Returns a function that receives an object and returns the list of
+        cells of its row. It is made once, for all objects."""
+        extractors = [self.make_column_extractor(column) for column in columns]
+        return lambda obj: [extract(obj) for extract in extractors]
+
+    def get_columns(self):
+        """Returns the detail band's ObjectValue widgets, sorted by position"""
         columns = [el for el in self.report.band_detail.elements if isinstance(el, ObjectValue)]
-        columns.sort(lambda a,b: cmp(a.left, b.left) or cmp(a.width, b.width))
+        columns.sort(key=lambda el: (el.left, el.width))
 
-        # First row with column names
-        if self.first_row_with_column_names:
-            cells = [(col.name or col.expression or col.attribute_name) for col in columns]
-            self.writer.writerow(cells)
+        return columns
 
-        while self._current_object_index < len(objects):
-            # Get current object from list
-            self._current_object = objects[self._current_object_index]
+    def generate_rows(self):
+        """Yields the rows (lists of cells) of the CSV output, one for each
+        object, as they are extracted"""
 
-            cells = []
+        self._current_object_index = 0
+        objects = self.report.get_objects_iterator()
 
-            for element in columns:
-                widget = element.clone()
+        columns = self.get_columns()
 
-                # Set widget colors
-                widget.font_color = self.report.default_font_color
+        # First row with column names
+        if self.first_row_with_column_names:
+            yield [(getattr(col, 'name', None) or col.expression or col.attribute_name) for col in columns]
 
-                # Set widget basic attributes
-                widget.instance = self._current_object
-                widget.generator = self
-                widget.report = self.report
-                widget.band = self.report.band_detail
-                widget.page = None
+        extract_row = self.make_row_extractor(columns)
 
-                cells.append(widget.text)
+        for obj in objects:
+            self._current_object = obj
+            yield extract_row(obj)
 
             # Next object
             self._current_object_index += 1
 
-            self.writer.writerow(cells)
+    def generate_csv(self):
+        """Generates the CSV output"""
+
+        self.start_writer()
+
+        rows = []
+
+        for row in self.generate_rows():
+            rows.append(row)
+
+            # Rows are written in chunks
+            if len(rows) >= self.rows_per_write:
+                self.writer.writerows(rows)
+                rows = []
+
+        if rows:
+            self.writer.writerows(rows)
+
+        if self._opened_file:
+            self._opened_file.close()
+            self._opened_file = None
+
+    def generate_chunks(self, chunk_size=None):
+        """Generates the CSV output as an iterator of encoded chunks (byte
+        strings) of about 'chunk_size' bytes, yielded as rows are extracted. This
+        is used to stream the output (i.e. in a HTTP response) using constant
+        memory, instead of writing it to a file.
+
+        The cache is not used, the same as by 'execute': streamed querysets
+        can't be read again to make the hash key and a chunked output would
+        have to be kept whole to be stored, so 'cache_status' is ignored.
+
+        Rows are written by 'writer_function' in a buffer. A 'writer' object
+        writes to its own file, so StreamingNotAvailable is raised if it is
+        informed (before any chunk, as this is not a generator itself)."""
+        if self.writer is not None:
+            raise StreamingNotAvailable('CSV output can\'t be streamed by a writer object. '
+                    'Inform a writer_function instead.')
+
+        # Disabled explicitly, so hooks checking it agree with 'execute'
+        self.cache_enabled = False
 
+        return self.iter_chunks(chunk_size or self.chunk_size)
+
+    def iter_chunks(self, chunk_size):
+        """Yields the encoded chunks for 'generate_chunks'"""
+        buf = io.StringIO()
+        writer = self.writer_function(buf, quoting=csv.QUOTE_MINIMAL)
+
+        super(CSVGenerator, self).execute()
+
+        # Calls the before_print event
+        self.report.do_before_print(generator=self)
+
+        for row in self.generate_rows():
+            writer.writerow(row)
+
+            if buf.tell() >= chunk_size:
+                yield buf.getvalue().encode(self.encode_to)
+                buf.seek(0)
+                buf.truncate()
+
+        if buf.tell():
+            yield buf.getvalue().encode(self.encode_to)
+
+        # Calls the after_print event
+        self.report.do_after_print(generator=self)
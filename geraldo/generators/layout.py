@@ -0,0 +1,199 @@
+"""Layout plans used by generators to render bands. They keep the kind of each
+element (to dispatch it without an isinstance chain) and its sizes calculated
+once, instead of calculating them for every object rendered."""
+
+from geraldo.utils import calculate_size
+from geraldo.widgets import Widget, Label, ObjectValue, SystemField
+from geraldo.graphics import Graphic, RoundRect, Rect, Line, Circle, Arc,\
+        Ellipse, Image
+from geraldo.barcodes import BarCode
+from geraldo.charts import BaseChart
+from geraldo.base import ManyElements, Element
+
+KIND_SYSTEM_FIELD = 'system-field'
+KIND_LABEL = 'label'
+KIND_WIDGET = 'widget'
+KIND_BOX = 'box'            # Rect and RoundRect
+KIND_FIXED = 'fixed'        # Line, Arc and Ellipse
+KIND_CIRCLE = 'circle'
+KIND_IMAGE = 'image'
+KIND_BARCODE = 'barcode'
+KIND_CHART = 'chart'
+KIND_GRAPHIC = 'graphic'    # Other graphics, that are just added to the page
+KIND_MANY = 'many'
+
+WIDGET_KINDS = (KIND_SYSTEM_FIELD, KIND_LABEL, KIND_WIDGET)
+
+# Cursors and heights used on page breaks are kept in integer micro-points
+# (millionths of point), so comparisons are exact and deterministic
+MICRO_POINTS = 1000000
+
+# Attributes used to calculate sizes for each kind. Images, barcodes and charts
+# have dynamic heights, so just their positions are here
+KIND_ATTRS = {
+    KIND_SYSTEM_FIELD: ('left','top','width','height'),
+    KIND_LABEL: ('left','top','width','height'),
+    KIND_WIDGET: ('left','top','width','height'),
+    KIND_BOX: ('left','top','height'),
+    KIND_FIXED: ('left','top','right','bottom','height'),
+    KIND_CIRCLE: ('left_center','top_center','top','height'),
+    KIND_IMAGE: ('left','top'),
+    KIND_BARCODE: ('left','top'),
+    KIND_CHART: ('left','top'),
+    KIND_GRAPHIC: ('top','height'),
+    }
+
+_element_kinds = {}
+_shareable_classes = {}
+
+def get_element_kind(element):
+    """Returns the kind of an element, the same way the generator would find
+    it checking its class"""
+    try:
+        return _element_kinds[element.__class__]
+    except KeyError:
+        pass
+
+    if isinstance(element, Widget):
+        if isinstance(element, SystemField):
+            kind = KIND_SYSTEM_FIELD
+        elif isinstance(element, Label):
+            kind = KIND_LABEL
+        else:
+            kind = KIND_WIDGET
+    elif isinstance(element, Graphic):
+        if isinstance(element, (RoundRect, Rect)):
+            kind = KIND_BOX
+        elif isinstance(element, Line):
+            kind = KIND_FIXED
+        elif isinstance(element, Circle):
+            kind = KIND_CIRCLE
+        elif isinstance(element, (Arc, Ellipse)):
+            kind = KIND_FIXED
+        elif isinstance(element, Image):
+            kind = KIND_IMAGE
+        elif isinstance(element, BarCode):
+            kind = KIND_BARCODE
+        elif isinstance(element, BaseChart):
+            kind = KIND_CHART
+        else:
+            kind = KIND_GRAPHIC
+    elif isinstance(element, ManyElements):
+        kind = KIND_MANY
+    else:
+        kind = None
+
+    _element_kinds[element.__class__] = kind
+    return kind
+
+def to_micro_points(size):
+    """Converts a calculated size (in points) to integer micro-points"""
+    return int(round(size * MICRO_POINTS))
+
+def has_events(obj, *events):
+    """Returns True if any of the informed events is set on the object or has
+    its 'do_*' method overrided out of Geraldo"""
+    for event in events:
+        if getattr(obj, event, None):
+            return True
+
+        method = getattr(obj.__class__, 'do_'+event, None)
+        if method is not None and not getattr(method, '__module__', '').startswith('geraldo.'):
+            return True
+
+    return False
+
+def is_shareable(element):
+    """Returns True if the element can be rendered as a RenderedWidget
+    sharing its template: labels and object values with no events and having
+    their texts resolved on render."""
+    cls = element.__class__
+    if cls not in _shareable_classes:
+        _shareable_classes[cls] = get_element_kind(element) == KIND_LABEL and\
+                cls.text in (Label.text, ObjectValue.text) and\
+                cls.get_rect is Element.get_rect
+
+    if not _shareable_classes[cls] or has_events(element, 'before_print', 'after_print'):
+        return False
+
+    if isinstance(element, ObjectValue):
+        return element.stores_text_in_cache
+
+    return not element.get_value
+
+class ElementLayout(object):
+    """Kind and calculated sizes of an element of a band. The sizes are
+    calculated again only when the element raw values change (i.e. by events or
+    by the band width)."""
+
+    element = None
+    kind = None
+
+    def __init__(self, element):
+        self.element = element
+        self.kind = get_element_kind(element)
+        self.attrs = KIND_ATTRS.get(self.kind, ())
+        self.raw = None
+        self.sizes = None
+        self.rect_sizes = None
+        self.shareable = is_shareable(element)
+        self.working_widget = None
+
+    def get_working_widget(self, generator, band):
+        """Returns a clone of a shareable widget, reused to resolve its text
+        for every object"""
+        if self.working_widget is None:
+            widget = self.working_widget = self.element.clone()
+            widget.font_color = generator.report.default_font_color
+            widget.generator = generator
+            widget.report = generator.report
+            widget.band = band
+
+        # Position is replaced by the rendering and text is cached by object
+        self.working_widget.left = self.element.left
+        self.working_widget.top = self.element.top
+        self.working_widget._cached_text = None
+
+        return self.working_widget
+
+    def get_sizes(self, generator, element):
+        """Returns a dictionary with the sizes calculated by the generator for
+        the element (that is a clone of the planned one)"""
+        raw = tuple([getattr(element, attr) for attr in self.attrs])
+
+        if raw != self.raw:
+            self.sizes = dict(zip(self.attrs, [generator.calculate_size(value) for value in raw]))
+            self.rect_sizes = None
+            self.raw = raw
+
+        return self.sizes
+
+    def get_rect_sizes(self):
+        """Returns the sizes used by widgets' borders rects, always calculated
+        by the function 'calculate_size'"""
+        if self.rect_sizes is None:
+            self.rect_sizes = dict(zip(self.attrs, [calculate_size(value) for value in self.raw]))
+
+        return self.rect_sizes
+
+class BandLayout(object):
+    """Layouts of the elements of a band and its calculated sizes"""
+
+    band = None
+
+    def __init__(self, band):
+        self.band = band
+        self.elements = list(band.elements)
+        self.layouts = [ElementLayout(element) for element in self.elements]
+
+    def is_valid(self):
+        """Returns False if the band elements list changed after planned"""
+        elements = self.band.elements
+        if len(elements) != len(self.elements):
+            return False
+
+        for element, planned in zip(elements, self.elements):
+            if element is not planned:
+                return False
+
+        return True
@@ -1,5 +1,5 @@
 import datetime, os
-from .base import ReportGenerator
+from .base import ReportGenerator, RenderedWidget
 
 from reportlab.pdfgen.canvas import Canvas
 from reportlab.lib.styles import ParagraphStyle
@@ -8,7 +8,6 @@ from reportlab.lib.units import cm
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.fonts import addMapping
-import collections
 
 try:
     # Try to import pyPdf, a library to combine lots of PDF files
@@ -19,17 +18,19 @@ try:
 except ImportError:
     pyPdf = None
 
-DEFAULT_TEMP_DIR = '/tmp/'
-
-from geraldo.utils import get_attr_value, calculate_size
+from geraldo.utils import get_attr_value, calculate_size, LRUCache
 from geraldo.widgets import Widget, Label, SystemField
 from geraldo.graphics import Graphic, RoundRect, Rect, Line, Circle, Arc,\
         Ellipse, Image
 from geraldo.barcodes import BarCode
-from geraldo.cache import make_hash_key, get_cache_backend, CACHE_DISABLED
+from geraldo.cache import make_hash_key, get_cache_backend, CACHE_DISABLED, CACHE_BY_RENDER
+from geraldo.generators.layout import has_events
+from geraldo.generators.textmetrics import get_text_height, make_text_line
 from geraldo.charts import BaseChart
 from geraldo.exceptions import AbortEvent
 
+DEFAULT_TEMP_DIR = '/tmp/'
+
 class PDFGenerator(ReportGenerator):
     """This is a generator to output a PDF using ReportLab library with
     preference by its Platypus API"""
@@ -45,11 +46,19 @@ class PDFGenerator(ReportGenerator):
     temp_files_max_pages = 10
     temp_directory = DEFAULT_TEMP_DIR
 
+    single_pass = False # Draws pages on canvas as soon as they are rendered
+    paragraphs_cache_size = 1000 # Wrapped paragraphs kept to be reused
+    draw_text_lines = True # Draws simple one-line texts without Paragraph
+    measure_texts = True # Calculates texts heights without Paragraph
+    _deferred_widgets = None
+    _drawn_pages = 0
+    _generated_pages = 0
+
     mimetype = 'application/pdf'
 
     def __init__(self, report, filename=None, canvas=None, return_canvas=False,
             multiple_canvas=None, temp_directory=None, cache_enabled=None,
-            **kwargs):
+            single_pass=None, **kwargs):
         super(PDFGenerator, self).__init__(report, **kwargs)
 
         self.filename = filename
@@ -57,6 +66,11 @@ class PDFGenerator(ReportGenerator):
         self.return_canvas = return_canvas
         self.temp_directory = temp_directory or self.temp_directory
 
+        if single_pass is not None:
+            self.single_pass = single_pass
+
+        self._paragraphs_cache = LRUCache(self.paragraphs_cache_size)
+
         # Cache enabled
         if cache_enabled is not None:
             self.cache_enabled = cache_enabled
@@ -97,6 +111,10 @@ class PDFGenerator(ReportGenerator):
         # Calls the before_print event
         self.report.do_before_print(generator=self)
 
+        # Renders and generates pages at once
+        if self.can_generate_in_single_pass():
+            return self.execute_in_single_pass()
+
         # Render pages
         self.render_bands()
 
@@ -116,6 +134,7 @@ class PDFGenerator(ReportGenerator):
 
         # Generate the report pages (here it happens)
         self.generate_pages()
+        self.close_spool()
 
         # Calls the after_print event
         self.report.do_after_print(generator=self)
@@ -135,24 +154,131 @@ class PDFGenerator(ReportGenerator):
         # Store in the cache
         self.store_in_cache()
 
+    def can_generate_in_single_pass(self):
+        """Returns True if pages can be drawn while they are rendered. This is not
+        possible when rendered pages are returned or used to the cache, when
+        multiple canvas are used or if there is a 'before_generate' event."""
+        if not self.single_pass or self.return_pages or self.multiple_canvas:
+            return False
+
+        if self.cache_enabled and self.report.cache_status == CACHE_BY_RENDER:
+            return False
+
+        return not has_events(self.report, 'before_generate')
+
+    def execute_in_single_pass(self):
+        """Renders the bands drawing every page as soon as a new one starts.
+        System fields depending on the page count are drawn as references to
+        PDF forms, filled when the page count is known."""
+        self._generation_datetime = datetime.datetime.now()
+        self._deferred_widgets = []
+        self._drawn_pages = self._generated_pages = 0
+
+        # Initializes the definitive PDF canvas
+        self.start_pdf()
+
+        # Render pages (closed ones are drawn by 'append_new_page')
+        self.render_bands()
+        self.draw_closed_pages(len(self._rendered_pages))
+        self.close_spool()
+        self.fill_deferred_widgets()
+
+        # Calls the after_print event
+        self.report.do_after_print(generator=self)
+
+        # Returns the canvas
+        if self.return_canvas:
+            return self.canvas
+
+        # Saves the canvas - only if it didn't return it
+        self.close_current_canvas()
+
+        # Store in the cache
+        self.store_in_cache()
+
+    def append_new_page(self):
+        # The current page is closed when a new one starts
+        if self._deferred_widgets is not None:
+            self.draw_closed_pages(len(self._rendered_pages))
+
+        super(PDFGenerator, self).append_new_page()
+
+    def draw_closed_pages(self, count):
+        """Draws the rendered pages not drawn yet until the informed count,
+        releasing their elements"""
+        # Page number is also used by the rendering
+        rendering_page_number = self._current_page_number
+
+        while self._drawn_pages < count:
+            page = self._rendered_pages[self._drawn_pages]
+            self._drawn_pages += 1
+
+            # Pages with no elements are not generated
+            if page.is_empty():
+                continue
+
+            self._current_page_number = self._generated_pages + 1
+            self.generate_page(page.elements, self._generated_pages)
+            self._generated_pages += 1
+
+            page._elements = []
+            page._spool = None
+
+        self._current_page_number = rendering_page_number
+
+    def get_page_count(self):
+        """Counts the pages already drawn in single pass, as their elements
+        were released, and the not empty ones not drawn yet"""
+        if self._deferred_widgets is None:
+            return super(PDFGenerator, self).get_page_count()
+
+        return self._generated_pages + len([page for page in
+            self._rendered_pages[self._drawn_pages:] if not page.is_empty()])
+
+    def depends_on_page_count(self, widget):
+        """Returns True if a system field can't be drawn before knowing the page
+        count"""
+        return bool(widget.get_value) or 'page_count' in widget.expression or\
+                'last_page_number' in widget.expression or 'var:' in widget.expression
+
+    def fill_deferred_widgets(self):
+        """Draws the deferred system fields in their forms, now with the known
+        page count"""
+        for name, widget in self._deferred_widgets:
+            widget.fields['page_count'] = self.get_page_count()
+
+            self.canvas.beginForm(name, 0, 0, *self.report.page_size)
+            self.set_fill_color(widget.font_color)
+            self.draw_widget_text(widget, self.canvas)
+            self.canvas.endForm()
+
     def get_hash_key(self, objects):
         """Appends pdf extension to the hash_key"""
         return super(PDFGenerator, self).get_hash_key(objects) + '.pdf'
 
     def store_in_cache(self):
-        if not self.cache_enabled or self.report.cache_status == CACHE_DISABLED:
+        if not self.uses_cache():
             return
 
         # Gest canvas content to store in the cache
         if isinstance(self.filename, str):
-            fp = file(self.filename, 'rb')
-            content = fp.read()
-            fp.close()
-        elif hasattr(self.filename, 'read') and isinstance(self.filename.read, collections.Callable):
+            return self.store_file_in_cache(self.filename)
+        elif hasattr(self.filename, 'getvalue') and callable(self.filename.getvalue):
+            content = self.filename.getvalue()
+        elif hasattr(self.filename, 'seek') and callable(self.filename.seek) and\
+             hasattr(self.filename, 'read') and callable(self.filename.read):
+            # The canvas was written until the end, so it's read from the start
+            position = self.filename.tell()
+            self.filename.seek(0)
             content = self.filename.read()
+            self.filename.seek(position)
         else:
             return False
 
+        # Empty content would be restored as a blank file
+        if not content:
+            return False
+
         return super(PDFGenerator, self).store_in_cache(content)
 
     def start_canvas(self, filename=None):
@@ -263,12 +389,10 @@ class PDFGenerator(ReportGenerator):
     def get_top_pos(self):
         """Since the coordinates are bottom-left on PDF, we have to use this to get
         the current top position, considering also the top margin."""
-        ret = self.calculate_size(self.report.page_size[1]) - self.calculate_size(self.report.margin_top) - self._current_top_position
+        page_height, margin_top, margin_bottom, header_height, footer_height, client_height =\
+                self.get_page_geometry()
 
-        if self.report.band_page_header:
-            ret -= self.calculate_size(self.report.band_page_header.height)
-
-        return ret
+        return page_height - margin_top - self._current_top_position - header_height
 
     def make_paragraph(self, text, style=None):
         """Uses the Paragraph class to return a new paragraph object"""
@@ -278,6 +402,44 @@ class PDFGenerator(ReportGenerator):
         """Wraps the paragraph on the height/width informed"""
         paragraph.wrapOn(self.canvas, width, height)
 
+    def make_wrapped_paragraph(self, text, band, style, width, height):
+        """Returns a paragraph wrapped on the width informed. Wrapped paragraphs
+        are kept in a cache by text, style and width, shared by rendering and
+        generating, so repeated values are measured just once."""
+        p_style = self.make_paragraph_style(band, style)
+
+        # The style is kept alive by the cached paragraph, so its id is unique
+        key = (text, width, id(p_style))
+
+        para = self._paragraphs_cache.get(key)
+        if para is None:
+            if self.draw_text_lines:
+                para = make_text_line(text, p_style, width)
+
+            if para is None:
+                para = Paragraph(text, p_style)
+                para.wrapOn(self.canvas, width, height)
+
+            self._paragraphs_cache.set(key, para)
+
+        return para
+
+    def get_text_height(self, text, band, style, width, height):
+        """Returns the height of a text wrapped on the width informed. Plain texts
+        are measured by glyph widths, without making paragraphs."""
+        p_style = self.make_paragraph_style(band, style)
+
+        para = self._paragraphs_cache.get((text, width, id(p_style)))
+        if para is not None:
+            return para.height
+
+        if self.measure_texts:
+            text_height = get_text_height(text, p_style, width)
+            if text_height is not None:
+                return text_height
+
+        return self.make_wrapped_paragraph(text, band, style, width, height).height
+
     def wrap_barcode_on(self, barcode, width, height):
         """Wraps the barcode on the height/width informed"""
         barcode.wrapOn(self.canvas, width, height)
@@ -296,18 +458,7 @@ class PDFGenerator(ReportGenerator):
         """Sets the stroke/line width for shapes"""
         self.canvas.setLineWidth(width)
 
-    def make_paragraph_style(self, band, style=None):
-        """Merge report default_style + band default_style + widget style"""
-        d_style = self.report.default_style.copy()
-
-        if band.default_style:
-            for k,v in list(band.default_style.items()):
-                d_style[k] = v
-
-        if style:
-            for k,v in list(style.items()):
-                d_style[k] = v
-
+    def make_style_from_dict(self, d_style):
         return ParagraphStyle(name=datetime.datetime.now().strftime('%H%M%S'), **d_style)
 
     def keep_in_frame(self, widget, width, height, paragraphs, mode, persistent=False):
@@ -327,7 +478,7 @@ class PDFGenerator(ReportGenerator):
         """Specific method that generates the pages"""
         self._generation_datetime = datetime.datetime.now()
 
-        for num, page in enumerate([page for page in self._rendered_pages if page.elements]):
+        for num, page in enumerate([page for page in self._rendered_pages if not page.is_empty()]):
             self._current_page_number = num + 1
 
             # Multiple canvas support (closes current and creates a new
@@ -337,35 +488,39 @@ class PDFGenerator(ReportGenerator):
                 del self.canvas
                 self.start_canvas()
 
-            # Loop at band widgets
-            for element in page.elements:
-                # Widget element
-                if isinstance(element, Widget):
-                    widget = element
-    
-                    # Set element colors
-                    self.set_fill_color(widget.font_color)
-    
-                    self.generate_widget(widget, self.canvas, num)
-    
-                # Graphic element
-                elif isinstance(element, Graphic):
-                    graphic = element
-    
-                    # Set element colors
-                    self.set_fill_color(graphic.fill_color)
-                    self.set_stroke_color(graphic.stroke_color)
-                    self.set_stroke_width(graphic.stroke_width)
-    
-                    self.generate_graphic(graphic, self.canvas)
-
-            self.canvas.showPage()
+            self.generate_page(page.elements, num)
 
         # Multiple canvas support (closes the current one)
         if self.multiple_canvas:
             self.close_current_canvas()
             del self.canvas
 
+    def generate_page(self, elements, num):
+        """Draws the elements of a page on canvas"""
+        # Loop at band widgets
+        for element in elements:
+            # Widget element (rendered records have Label templates)
+            if isinstance(element, (Widget, RenderedWidget)):
+                widget = element
+
+                # Set element colors
+                self.set_fill_color(widget.font_color)
+
+                self.generate_widget(widget, self.canvas, num)
+
+            # Graphic element
+            elif isinstance(element, Graphic):
+                graphic = element
+
+                # Set element colors
+                self.set_fill_color(graphic.fill_color)
+                self.set_stroke_color(graphic.stroke_color)
+                self.set_stroke_width(graphic.stroke_width)
+
+                self.generate_graphic(graphic, self.canvas)
+
+        self.canvas.showPage()
+
     def generate_widget(self, widget, canvas=None, page_number=0):
         """Renders a widget element on canvas"""
         if isinstance(widget, SystemField):
@@ -386,28 +541,50 @@ class PDFGenerator(ReportGenerator):
         if not widget.visible:
             return
 
+        # On single pass, fields depending on page count are drawn later in
+        # a form, that is referred here
+        if self._deferred_widgets is not None and isinstance(widget, SystemField) and\
+           self.depends_on_page_count(widget):
+            widget.fields = dict(widget.fields) # Fields dict is shared by clones
+            name = 'geraldo-deferred-%d' % len(self._deferred_widgets)
+            self._deferred_widgets.append((name, widget))
+            canvas.doForm(name)
+
+            # Calls the after_print event
+            widget.do_after_print(generator=self)
+            return
+
         # This includes also the SystemField above
-        if isinstance(widget, Label):
+        if isinstance(widget, (Label, RenderedWidget)):
+            self.draw_widget_text(widget, canvas)
+
+            # Calls the after_print event
+            widget.do_after_print(generator=self)
+
+    def draw_widget_text(self, widget, canvas):
+        """Draws the text of a label (or system field) on canvas, truncated if
+        it overflows and the widget is set to truncate it"""
+        if widget.truncate_overflow:
             para = Paragraph(widget.text, self.make_paragraph_style(widget.band, widget.style))
             para.wrapOn(canvas, widget.width, widget.height)
 
-            if widget.truncate_overflow:
-                keep = self.keep_in_frame(
-                        widget,
-                        self.calculate_size(widget.width),
-                        self.calculate_size(widget.height),
-                        [para],
-                        mode='truncate',
-                        )
-                keep.drawOn(canvas, widget.left, widget.top)
-            elif isinstance(widget, SystemField):
+            keep = self.keep_in_frame(
+                    widget,
+                    self.calculate_size(widget.width),
+                    self.calculate_size(widget.height),
+                    [para],
+                    mode='truncate',
+                    )
+            keep.drawOn(canvas, widget.left, widget.top)
+        else:
+            para = self.make_wrapped_paragraph(widget.text, widget.band, widget.style,
+                    widget.width, widget.height)
+
+            if isinstance(widget, SystemField):
                 para.drawOn(canvas, widget.left, widget.top - para.height)
             else:
                 para.drawOn(canvas, widget.left, widget.top)
 
-            # Calls the after_print event
-            widget.do_after_print(generator=self)
-
     def generate_graphic(self, graphic, canvas=None):
         """Renders a graphic element"""
         canvas = canvas or self.canvas
@@ -0,0 +1,84 @@
+"""Temporary storage for rendered pages, used to keep in memory just the latest
+pages of big reports while the older ones wait on disk to be generated."""
+
+import tempfile, pickle
+
+# Types serialized by value. Other objects found inside the elements (report,
+# bands, generator, widgets templates, colors, functions, etc.) are stored just
+# as references to the objects in memory. Queryset objects (the 'instance' of
+# the elements) are serialized by value, so they are not kept in memory
+VALUE_TYPES = (type(None), bool, int, float, complex, str, bytes, tuple, list,
+        dict, set, frozenset)
+
+class SpoolPickler(pickle.Pickler):
+    """Pickler that serializes page elements by value and the objects they
+    share with the rest of the report by reference"""
+
+    def __init__(self, file, spool, elements):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self.spool = spool
+        self.elements_ids = set([id(el) for el in elements])
+        self.instances = dict([(id(el.instance), el.instance) for el in elements
+            if getattr(el, 'instance', None) is not None])
+        self.instances_values = {}
+
+    def persistent_id(self, obj):
+        if id(obj) in self.instances:
+            # Objects are serialized with all their values, once by page
+            if id(obj) not in self.instances_values:
+                self.instances_values[id(obj)] = ('value', pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+            return self.instances_values[id(obj)]
+
+        if type(obj) in VALUE_TYPES or id(obj) in self.elements_ids:
+            return None
+
+        self.spool.references[id(obj)] = obj
+        return id(obj)
+
+class SpoolUnpickler(pickle.Unpickler):
+    def __init__(self, file, spool):
+        pickle.Unpickler.__init__(self, file)
+        self.spool = spool
+        self.instances = {}
+
+    def persistent_load(self, pid):
+        if isinstance(pid, tuple):
+            if pid[1] not in self.instances:
+                self.instances[pid[1]] = pickle.loads(pid[1])
+            return self.instances[pid[1]]
+
+        return self.spool.references[pid]
+
+class PageSpool(object):
+    """A temporary file where pages elements are stored after the pages are
+    closed, and read back when they are generated"""
+
+    def __init__(self, directory=None):
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.references = {}
+
+    def dump(self, elements):
+        """Stores a list of elements, returning its position in the file, or
+        None if it can't be serialized (and so must be kept in memory)"""
+        self.file.seek(0, 2)
+        offset = self.file.tell()
+
+        try:
+            SpoolPickler(self.file, self, elements).dump(elements)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            self.file.truncate(offset)
+            return None
+
+        return offset, self.file.tell() - offset
+
+    def load(self, position):
+        """Reads back a list of elements stored in the informed position"""
+        offset, length = position
+        self.file.seek(offset)
+
+        return SpoolUnpickler(self.file, self).load()
+
+    def close(self):
+        """Removes the temporary file and releases the referred objects"""
+        self.file.close()
+        self.references = {}
@@ -1,8 +1,8 @@
 import datetime
-from .base import ReportGenerator
+from .base import ReportGenerator, RenderedWidget
 
 from geraldo.base import cm, TA_CENTER, TA_RIGHT
-from geraldo.utils import get_attr_value, calculate_size
+from geraldo.utils import get_attr_value, calculate_size, SIZE_UNITS
 from geraldo.widgets import Widget, Label, SystemField
 from geraldo.graphics import Graphic, RoundRect, Rect, Line, Circle, Arc,\
         Ellipse, Image
@@ -75,6 +75,8 @@ class TextGenerator(ReportGenerator):
     escapes_page_start = ''
     escapes_page_end = ''
 
+    _size_units = None
+
     mimetype = 'text/plain'
 
     def __init__(self, report, cache_enabled=None, **kwargs):
@@ -110,6 +112,7 @@ class TextGenerator(ReportGenerator):
 
         # Generate the pages
         text = self.generate_pages()
+        self.close_spool()
 
         # Encode
         if self.encode_to:
@@ -131,14 +134,25 @@ class TextGenerator(ReportGenerator):
         return super(TextGenerator, self).get_hash_key(objects) + '.txt'
 
     def calculate_size(self, size):
-        """Uses the function 'calculate_size' to calculate a size"""
+        """Uses the function 'calculate_size' to calculate a size, supporting
+        also 'rows' and 'cols' units"""
         if isinstance(size, str):
-            if size.endswith('*cols') or size.endswith('*col'):
-                return int(size.split('*')[0]) * self.character_width
-            elif size.endswith('*rows') or size.endswith('*row'):
-                return int(size.split('*')[0]) * self.row_height
+            return calculate_size(size, self.get_size_units())
+
+        return size
+
+    def get_size_units(self):
+        """Returns the units for size expressions, including rows and cols, made
+        again only if row height or character width change"""
+        raw = (self.row_height, self.character_width)
+
+        if not self._size_units or self._size_units[0] != raw:
+            units = dict(SIZE_UNITS)
+            units['row'] = units['rows'] = self.row_height
+            units['col'] = units['cols'] = self.character_width
+            self._size_units = (raw, units)
 
-        return calculate_size(size)
+        return self._size_units[1]
 
     def make_paragraph(self, text, style=None): # TODO: make style with basic functions, like alignment, bold, emphasis (italic), etc
         """Uses the Paragraph class to return a new paragraph object"""
@@ -152,18 +166,7 @@ class TextGenerator(ReportGenerator):
         """Do nothing with a barcode"""
         pass
 
-    def make_paragraph_style(self, band, style=None):
-        """Merge report default_style + band default_style + widget style"""
-        d_style = self.report.default_style.copy()
-
-        if band.default_style:
-            for k,v in list(band.default_style.items()):
-                d_style[k] = v
-
-        if style:
-            for k,v in list(style.items()):
-                d_style[k] = v
-
+    def make_style_from_dict(self, d_style):
         return dict(name=datetime.datetime.now().strftime('%H%m%s'), **d_style)
 
     def keep_in_frame(self, widget, width, height, paragraphs, mode):
@@ -181,7 +184,7 @@ class TextGenerator(ReportGenerator):
         # Escapes
         self.add_escapes_report_start();
 
-        for num, page in enumerate([page for page in self._rendered_pages if page.elements]):
+        for num, page in enumerate([page for page in self._rendered_pages if not page.is_empty()]):
             # Escapes
             self.add_escapes_page_start(num);
 
@@ -192,7 +195,7 @@ class TextGenerator(ReportGenerator):
             # Loop at band widgets
             for element in page.elements:
                 # Widget element
-                if isinstance(element, Widget):
+                if isinstance(element, (Widget, RenderedWidget)):
                     self.generate_widget(element, _page_output, num)
 
             # Adds the page output to output string
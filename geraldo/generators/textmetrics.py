@@ -0,0 +1,220 @@
+"""Text metrics used to know how many lines a text takes in a width without
+making Platypus paragraphs. Glyph widths are cached per font, and texts are
+broken in lines the same way ReportLab's Paragraph breaks texts with no
+markup (including the split of words longer than the lines). Texts fitting in
+one line are drawn by TextLine, also without paragraphs."""
+
+from reportlab import rl_config
+from reportlab.pdfbase.pdfmetrics import stringWidth, getAscentDescent
+from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT, TA_JUSTIFY
+
+_fonts_metrics = {}
+
+class FontMetrics(object):
+    """Widths of the glyphs of a font, in thousandths of the font size. Each
+    width is read from ReportLab just once. Kerning is not considered, as it
+    isn't by Paragraph."""
+
+    def __init__(self, font_name):
+        self.font_name = font_name
+        self.widths = {}
+
+    def char_width(self, char):
+        try:
+            return self.widths[char]
+        except KeyError:
+            width = self.widths[char] = stringWidth(char, self.font_name, 1000)
+            return width
+
+    def string_width(self, text, font_size):
+        widths = self.widths
+        try:
+            total = sum([widths[char] for char in text])
+        except KeyError:
+            total = sum([self.char_width(char) for char in text])
+
+        return total * 0.001 * font_size
+
+def get_font_metrics(font_name):
+    """Returns the glyph widths table of a font, made on the first use"""
+    try:
+        return _fonts_metrics[font_name]
+    except KeyError:
+        metrics = _fonts_metrics[font_name] = FontMetrics(font_name)
+        return metrics
+
+def is_plain_text(text):
+    """Returns True if the text has no markup, entities or special spaces
+    (non-breaking or soft hyphens), so Paragraph would take it as just words"""
+    return '<' not in text and '&' not in text and '\xa0' not in text and '\xad' not in text
+
+def is_simple_style(style):
+    """Returns True if a paragraph style has nothing changing the way texts are
+    broken or drawn by Paragraph other than fonts, indents and alignment"""
+    return not (style.backColor or (style.borderColor and style.borderWidth) or style.wordWrap or
+            getattr(style, 'textTransform', None) or getattr(style, 'endDots', None) or
+            getattr(style, 'shaping', 0) or getattr(style, 'hyphenationLang', '') or
+            getattr(style, 'uriWasteReduce', 0) or getattr(style, 'embeddedHyphenation', 0) or
+            getattr(style, 'autoLeading', '') not in ('', 'off', None))
+
+class TextLine(object):
+    """A markup-free text that fits in just one line, drawn with direct canvas
+    text operations at the same position a Paragraph would draw it. Used
+    instead of Paragraph for the most common texts (numbers, short strings)."""
+
+    def __init__(self, text, style, width, text_width):
+        self.text = text
+        self.style = style
+        self.width = width
+        self.height = style.leading
+
+        # Position of the baseline (the same rules of Paragraph.drawPara)
+        if rl_config.paraFontSizeHeightOffset:
+            self.baseline = self.height - style.fontSize
+        else:
+            self.baseline = self.height - getAscentDescent(style.fontName, style.fontSize)[0]
+
+        line_left = style.leftIndent + style.firstLineIndent
+        line_width = width - line_left - style.rightIndent
+
+        if style.alignment == TA_RIGHT:
+            self.offset = line_left + line_width - text_width
+        elif style.alignment == TA_CENTER:
+            self.offset = line_left + 0.5 * (line_width - text_width)
+        else:
+            self.offset = line_left
+
+    def drawOn(self, canvas, x, y):
+        canvas.saveState()
+        canvas.setFillColor(self.style.textColor)
+        canvas.setFont(self.style.fontName, self.style.fontSize, self.style.leading)
+        canvas.drawString(x + self.offset, y + self.baseline, self.text)
+        canvas.restoreState()
+
+def make_text_line(text, style, width):
+    """Returns a TextLine for the text if it has no markup, no spaces to be
+    collapsed and fits in one line with a simple style, or None if it must be
+    drawn by a Paragraph."""
+    if not text or not is_plain_text(text) or ' '.join(text.split()) != text:
+        return None
+
+    if not is_simple_style(style) or\
+       (style.alignment == TA_JUSTIFY and getattr(style, 'justifyLastLine', 0)) or\
+       style.alignment not in (TA_LEFT, TA_CENTER, TA_RIGHT, TA_JUSTIFY):
+        return None
+
+    text_width = stringWidth(text, style.fontName, style.fontSize)
+    if text_width > width - style.leftIndent - style.firstLineIndent - style.rightIndent:
+        return None
+
+    return TextLine(text, style, width, text_width)
+
+class SplitWord(str):
+    """Piece of a long word split to fit the lines"""
+
+class SplitWordEnd(SplitWord):
+    """The latest piece of a split long word"""
+
+def split_long_word(word, line_width, max_widths, line_number, metrics, font_size):
+    """Splits a word in pieces fitting the current and next lines"""
+    pieces = []
+    max_line = len(max_widths) - 1
+    piece = ''
+    max_width = max_widths[min(max_line, line_number)]
+    max_width_next = max_widths[min(max_line, line_number + 1)]
+
+    for char in word:
+        char_width = metrics.string_width(char, font_size)
+        new_line_width = line_width + char_width
+
+        if new_line_width > max_width and (piece or char_width <= max_width_next):
+            pieces.append(SplitWord(piece))
+            line_number += 1
+            max_width = max_widths[min(max_line, line_number)]
+            new_line_width = char_width
+            piece = ''
+
+        piece += char
+        line_width = new_line_width
+
+    pieces.append(SplitWordEnd(piece))
+    return pieces
+
+def count_lines(text, font_name, font_size, max_widths, space_shrinkage=0,
+        split_long_words=True):
+    """Returns the number of lines a plain text takes, breaking it by the
+    informed widths (the latest one is repeated for the next lines)"""
+    words = text.split()
+    if not words:
+        return 0
+
+    metrics = get_font_metrics(font_name)
+    space_width = metrics.string_width(' ', font_size)
+    space_shrink = space_shrinkage * space_width
+
+    max_line = len(max_widths) - 1
+    line_number = 0
+    max_width = max_widths[0]
+    line_words = 0
+    current_width = -space_width
+    forced_split = False
+    lines = 0
+
+    while words:
+        word = words.pop(0)
+        if not word and isinstance(word, SplitWord):
+            forced_split = True
+
+        word_width = metrics.string_width(word, font_size)
+        new_width = current_width + space_width + word_width
+        limit_width = max_width + space_shrink * line_words
+
+        if new_width > limit_width and not forced_split and split_long_words and\
+           not isinstance(word, SplitWord) and\
+           word_width > max_widths[min(line_number, max_line)]:
+            words[0:0] = split_long_word(word, current_width + space_width, max_widths,
+                    line_number, metrics, font_size)
+            forced_split = True
+            continue
+
+        if new_width <= limit_width or not line_words or forced_split:
+            # Fits one more word in this line
+            if word:
+                line_words += 1
+
+            if forced_split:
+                forced_split = False
+                lines += 1
+                line_words = 0
+                current_width = -space_width
+                line_number += 1
+                max_width = max_widths[min(max_line, line_number)]
+            else:
+                current_width = new_width
+        else:
+            # Starts a new line with this word
+            lines += 1
+            line_words = 1
+            current_width = word_width
+            line_number += 1
+            max_width = max_widths[min(max_line, line_number)]
+
+    if line_words:
+        lines += 1
+
+    return lines
+
+def get_text_height(text, style, width):
+    """Returns the height a Paragraph would have for the text with the style,
+    wrapped in the width, or None if the text or the style are not simple
+    enough to be measured without making a Paragraph"""
+    if width < 1e-8 or not is_plain_text(text) or not is_simple_style(style):
+        return None
+
+    line_left = style.leftIndent + style.firstLineIndent
+    max_widths = [width - line_left - style.rightIndent, width - style.leftIndent - style.rightIndent]
+
+    lines = count_lines(text, style.fontName, style.fontSize, max_widths,
+            getattr(style, 'spaceShrinkage', 0), style.splitLongWords)
+
+    return lines * style.leading
@@ -1,10 +1,13 @@
-import sys
+import sys, re, weakref, threading
 import collections
 
 try:
     import reportlab
 except ImportError:
     cm = 28.346456692913385
+    mm = cm * 0.1
+    inch = 72.0
+    pica = 12.0
     A4 = (595.275590551181, 841.8897637795275)
     black = None
     TA_LEFT, TA_CENTER, TA_RIGHT = 0, 1, 2
@@ -15,7 +18,7 @@ else:
     from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT # Check this also
     from reportlab.lib.colors import black
 
-from .exceptions import AttributeNotFound
+from .exceptions import AttributeNotFound, InvalidSizeExpression
 
 try:
     from functools import wraps
@@ -49,29 +52,216 @@ SYSTEM_FIELD_CHOICES = {
     'report_author': 'Author',
 }
 
-def _get_memoized_value(func, args, kwargs):
-    """Used internally by memoize decorator to get/store function results"""
-    key = (repr(args), repr(kwargs))
-    
-    if not key in func._cache_dict:
-        ret = func(*args, **kwargs)
-        func._cache_dict[key] = ret
+MEMOIZE_MAXSIZE = 1000 # Default number of results kept by each memoize cache
 
-    return func._cache_dict[key]
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses maxsize currsize')
 
-def memoize(func):
-    """Decorator that stores function results in a dictionary to be used on the
-    next time that the same arguments were informed."""
+_kwargs_mark = object()
+_repr_mark = object()
+_missing = object()
 
-    func._cache_dict = {}
+def _make_memoize_key(args, kwargs):
+    """Returns a key for the arguments. Hashable arguments are used as they are,
+    with their types (so equal values like 1, 1.0 and True don't share results),
+    and the others by their representation."""
+    key = args + tuple([type(value) for value in args])
+    if kwargs:
+        items = sorted(kwargs.items())
+        key += (_kwargs_mark,) + tuple(items) + tuple([type(value) for name, value in items])
 
-    def _inner(*args, **kwargs):
-        return _get_memoized_value(func, args, kwargs)
+    try:
+        hash(key)
+    except TypeError:
+        key = (_repr_mark, repr(args), repr(sorted(kwargs.items())))
+
+    return key
+
+class MemoizeCache(object):
+    """Results stored for a memoized function (or for a method on an
+    instance), with hit/miss counters"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = LRUCache(maxsize)
+        self.hits = self.misses = 0
+
+    def call(self, func, args, kwargs, key_args):
+        key = _make_memoize_key(key_args, kwargs)
+        value = self.items.get(key, _missing)
+
+        if value is _missing:
+            self.misses += 1
+            value = func(*args, **kwargs)
+            self.items.set(key, value)
+        else:
+            self.hits += 1
+
+        return value
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.items))
+
+    def clear(self):
+        self.items.clear()
+        self.hits = self.misses = 0
+
+class Memoized(object):
+    """A memoized function. When used as a method, results are stored for each
+    instance (by a weak reference to it), and released with the instance."""
+
+    def __init__(self, func, maxsize):
+        self.func = func
+        self.maxsize = maxsize
+        self.cache = MemoizeCache(maxsize)
+        self.instances = {}
+
+        wraps(func)(self)
+
+    def __call__(self, *args, **kwargs):
+        return self.cache.call(self.func, args, kwargs, args)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        return BoundMemoized(self, instance)
+
+    def get_instance_cache(self, instance):
+        """Returns the results cache of an instance, or None if it doesn't
+        support weak references"""
+        key = id(instance)
+
+        try:
+            ref, cache = self.instances[key]
+            if ref() is instance:
+                return cache
+        except KeyError:
+            pass
+
+        try:
+            ref = weakref.ref(instance, lambda ref: self.instances.pop(key, None))
+        except TypeError:
+            return None
+
+        cache = MemoizeCache(self.maxsize)
+        self.instances[key] = (ref, cache)
+
+        return cache
+
+    def cache_info(self):
+        return self.cache.info()
+
+    def cache_clear(self):
+        self.cache.clear()
+        self.instances.clear()
+
+class BoundMemoized(object):
+    """A memoized method bound to an instance"""
+
+    def __init__(self, memoized, instance):
+        self.memoized = memoized
+        self.instance = instance
 
-    if sys.version.startswith('2.4'):
-        return _inner
-    else:
-        return wraps(func)(_inner)
+    def __call__(self, *args, **kwargs):
+        cache = self.memoized.get_instance_cache(self.instance)
+
+        if cache is None:
+            return self.memoized(self.instance, *args, **kwargs)
+
+        return cache.call(self.memoized.func, (self.instance,) + args, kwargs, args)
+
+    def cache_info(self):
+        cache = self.memoized.get_instance_cache(self.instance)
+        return cache.info() if cache is not None else self.memoized.cache_info()
+
+    def cache_clear(self):
+        cache = self.memoized.get_instance_cache(self.instance)
+        if cache is not None:
+            cache.clear()
+
+def memoize(func=None, maxsize=MEMOIZE_MAXSIZE):
+    """Decorator that stores function results to be used on the next time that
+    the same arguments were informed. Just the latest 'maxsize' used results
+    are kept (all of them if it is None). Can be used also as
+    @memoize(maxsize=100).
+
+    On methods, results are stored for each instance and released with it."""
+    if func is None:
+        return lambda func: Memoized(func, maxsize)
+
+    return Memoized(func, maxsize)
+
+class AttrAccessor(object):
+    """Compiled accessor for an attribute path, like 'customer.address.city'.
+
+    The path is split just once, and for each part it remembers, by the type
+    of the objects, if the value is read as a key (i.e. dictionaries) instead of
+    trying to get it as an attribute before."""
+
+    def __init__(self, attr_path):
+        self.attr_path = attr_path
+        self.parts = tuple(attr_path.split('.'))
+        self._by_key = [{} for part in self.parts]
+
+    def reads_by_key(self, obj, part):
+        """Returns True if the part can only be found as a key on objects of
+        this type, because they have no custom attribute lookup, instance
+        dictionary nor class attribute with the same name"""
+        cls = type(obj)
+        if not hasattr(cls, '__getitem__') or hasattr(obj, '__dict__') or hasattr(cls, part):
+            return False
+
+        # Built-in types use the default attribute lookup
+        for klass in cls.__mro__:
+            if klass.__module__ != 'builtins' and\
+               ('__getattribute__' in vars(klass) or '__getattr__' in vars(klass)):
+                return False
+
+        return True
+
+    def __call__(self, obj):
+        val = obj
+
+        for part, by_key in zip(self.parts, self._by_key):
+            cls = type(val)
+            try:
+                key_only = by_key[cls]
+            except KeyError:
+                key_only = by_key[cls] = self.reads_by_key(val, part)
+
+            if not key_only:
+                try:
+                    val = getattr(val, part)
+                    continue
+                except AttributeError:
+                    pass
+
+            try:
+                val = val[part]
+            except (KeyError, TypeError):
+                raise AttributeNotFound('There is no attribute nor key "%s" in the object "%s"'%(part, repr(val)))
+
+        # Calls methods the same way it was done for each part of the path
+        for part in self.parts:
+            if not callable(val):
+                break
+            val = val()
+
+        return val
+
+_attr_accessors = {}
+
+def get_attr_accessor(attr_path):
+    """Returns the compiled accessor for an attribute path, that is a callable
+    receiving the object and returning the value, like 'get_attr_value' does."""
+    try:
+        return _attr_accessors[attr_path]
+    except KeyError:
+        if not attr_path:
+            raise Exception('Invalid attribute path \'%s\''%attr_path)
+
+        accessor = _attr_accessors[attr_path] = AttrAccessor(attr_path)
+        return accessor
 
 def get_attr_value(obj, attr_path):
     """This function gets an attribute value from an object. If the attribute
@@ -85,38 +275,253 @@ def get_attr_value(obj, attr_path):
         attribute_name = 'name.upper'
         attribute_name = 'customer.name.lower'
     """
-    if not attr_path:
-        raise Exception('Invalid attribute path \'%s\''%attr_path)
+    return get_attr_accessor(attr_path)(obj)
 
-    parts = attr_path.split('.')
+class LookaheadIterator(object):
+    """Wraps an iterable to consume its objects one by one, keeping only the
+    current and the previous objects in memory and making possible to peek
+    the next one before consuming it.
 
-    try:
-        val = getattr(obj, parts[0])
-    except AttributeError:
-        try:
-            val = obj[parts[0]]
-        except (KeyError, TypeError):
-            raise AttributeNotFound('There is no attribute nor key "%s" in the object "%s"'%(parts[0], repr(obj)))
+    Used to walk through big objects lists without loading them at once."""
 
-    if len(parts) > 1:
-        val = get_attr_value(val, '.'.join(parts[1:]))
+    _nothing = object()
 
-    if isinstance(val, collections.Callable):
-        val = val()
-        
-    return val
+    current = None
+    previous = None
 
-@memoize
-def calculate_size(size):
-    """Calculates the informed size. If this is a string or unicode, it is
-    converted to float using evaluation function"""
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self._next = self._nothing
+
+    def __iter__(self):
+        return self
+
+    def has_next(self):
+        """Returns True if there is at least one more object to consume"""
+        if self._next is self._nothing:
+            try:
+                self._next = next(self._iterator)
+            except StopIteration:
+                return False
+
+        return True
+
+    def peek(self):
+        """Returns the next object without consuming it"""
+        if not self.has_next():
+            raise StopIteration
+
+        return self._next
+
+    def __next__(self):
+        if not self.has_next():
+            raise StopIteration
+
+        self.previous = self.current
+        self.current, self._next = self._next, self._nothing
+
+        return self.current
+    next = __next__
+
+class SequenceRange(object):
+    """A read-only view on a range of a sequence, without copying its items.
+
+    Used to get the objects of a group from the report objects list."""
+
+    def __init__(self, sequence, start, stop):
+        self.sequence = sequence
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        sequence = self.sequence
+        for num in range(self.start, self.stop):
+            yield sequence[num]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return [self[num] for num in range(start, stop, step)]
+            return SequenceRange(self.sequence, self.start + start, self.start + max(start, stop))
+
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('SequenceRange index out of range')
+
+        return self.sequence[self.start + key]
+
+    def __repr__(self):
+        return repr(list(self))
+
+class LRUCache(object):
+    """A dictionary-like cache keeping just the latest 'maxsize' used items
+    (or all of them if it is None).
+
+    Used to reuse objects expensive to make (i.e. wrapped paragraphs) without
+    growing the memory consuming with big reports. It is thread safe, as it is
+    used by memoized functions shared by the process."""
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Returns the value for a key, marking it as the latest used"""
+        with self._lock:
+            try:
+                self._items.move_to_end(key)
+            except KeyError:
+                return default
+
+            return self._items[key]
+
+    def set(self, key, value):
+        """Stores a value, discarding the least recently used one if the cache
+        is full"""
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+
+            if self.maxsize is not None and len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+# Units known by size expressions. Generators can inform others (i.e. rows and
+# cols on text generator)
+SIZE_UNITS = {'cm': cm, 'mm': mm, 'inch': inch, 'pica': pica}
+
+_size_tokens = re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|([A-Za-z_]\w*)|(\S))')
+_size_expressions = {}
+
+class SizeExpression(object):
+    """A size expression (i.e. '10*cm' or '15.8*rows') compiled once to a tree
+    of functions, supporting numbers, units, + - * / and parenthesis. It is
+    called with a dictionary of units to get the calculated size."""
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = []
+
+        for number, name, symbol in _size_tokens.findall(expression):
+            if number:
+                self.tokens.append(('number', float(number)))
+            elif name:
+                self.tokens.append(('name', name))
+            elif symbol in '+-*/()':
+                self.tokens.append((symbol, None))
+            else:
+                self.error('unexpected "%s"' % symbol)
+
+        self.position = 0
+        self.function = self.parse_sum()
+
+        if self.position < len(self.tokens):
+            self.error('unexpected "%s"' % (self.tokens[self.position][1] or self.tokens[self.position][0]))
+
+        del self.tokens
+
+    def __call__(self, units):
+        return self.function(units)
+
+    def error(self, message):
+        raise InvalidSizeExpression('Invalid size expression "%s": %s' % (self.expression, message))
+
+    def next_token(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+
+    def parse_sum(self):
+        function = self.parse_product()
+
+        while self.next_token() in ('+', '-'):
+            operator = self.next_token()
+            self.position += 1
+            function = self.combine(operator, function, self.parse_product())
+
+        return function
+
+    def parse_product(self):
+        function = self.parse_factor()
+
+        while self.next_token() in ('*', '/'):
+            operator = self.next_token()
+            self.position += 1
+            function = self.combine(operator, function, self.parse_factor())
+
+        return function
+
+    def parse_factor(self):
+        if self.position >= len(self.tokens):
+            self.error('unexpected end')
+
+        kind, value = self.tokens[self.position]
+        self.position += 1
+
+        if kind == 'number':
+            return lambda units: value
+        elif kind == 'name':
+            expression = self.expression
+            def get_unit(units):
+                try:
+                    return units[value]
+                except KeyError:
+                    raise InvalidSizeExpression('Invalid size expression "%s": unknown unit "%s"'%(
+                        expression, value))
+            return get_unit
+        elif kind == '-':
+            function = self.parse_factor()
+            return lambda units: -function(units)
+        elif kind == '+':
+            return self.parse_factor()
+        elif kind == '(':
+            function = self.parse_sum()
+            if self.next_token() != ')':
+                self.error('missing ")"')
+            self.position += 1
+            return function
+
+        self.error('unexpected "%s"' % kind)
+
+    def combine(self, operator, left, right):
+        if operator == '+':
+            return lambda units: left(units) + right(units)
+        elif operator == '-':
+            return lambda units: left(units) - right(units)
+        elif operator == '*':
+            return lambda units: left(units) * right(units)
+        else:
+            return lambda units: left(units) / right(units)
+
+def get_size_expression(expression):
+    """Returns the compiled size expression, compiling it on the first use"""
+    try:
+        return _size_expressions[expression]
+    except KeyError:
+        compiled = _size_expressions[expression] = SizeExpression(expression)
+        return compiled
+
+def calculate_size(size, units=None):
+    """Calculates the informed size. If this is a string, it is calculated as
+    a size expression (i.e. '10*cm') with the units informed or the default
+    ones."""
     if isinstance(size, str):
-        return eval(size) # If you are thinking this is a semanthic bug, you must
-                          # be aware this 'eval' is necessary to calculate sizes
-                          # like '10*cm' or '15.8*rows'
-                          # I want to check if eval is better way to do it than
-                          # do a regex matching and calculate. TODO
-    
+        return get_size_expression(size)(units or SIZE_UNITS)
+
     return size
 
 # Replaced by ReportLab landscape and portrait functions
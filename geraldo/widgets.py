@@ -7,9 +7,9 @@ except NameError:
     from sets import Set as set     # Python 2.3 fallback 
 
 from .base import BAND_WIDTH, BAND_HEIGHT, Element, SubReport
-from .utils import get_attr_value, SYSTEM_FIELD_CHOICES, FIELD_ACTION_VALUE, FIELD_ACTION_COUNT,\
+from .utils import get_attr_accessor, SYSTEM_FIELD_CHOICES, FIELD_ACTION_VALUE, FIELD_ACTION_COUNT,\
         FIELD_ACTION_AVG, FIELD_ACTION_MIN, FIELD_ACTION_MAX, FIELD_ACTION_SUM,\
-        FIELD_ACTION_DISTINCT_COUNT, cm, black
+        FIELD_ACTION_DISTINCT_COUNT, cm, black, LRUCache
 from .exceptions import AttributeNotFound
 
 class Widget(Element):
@@ -73,7 +73,7 @@ class Label(Widget):
     def clone(self):
         new = super(Label, self).clone()
 
-        if not isinstance(self._text, collections.Callable):
+        if not callable(self._text):
             new._text = self._text
 
         return new
@@ -81,6 +81,104 @@ class Label(Widget):
 EXP_QUOTED = re.compile('\w\(([^\'"].+?[^\'"])(|,.*?)\)')
 EXP_QUOTED_SUB = re.compile('\(([^\'"].+?[^\'"])(|,.*?)\)')
 EXP_TOKENS = re.compile('([\w\._]+|\*\*|\+|\-|\*|\/)')
+EXP_OPERATORS = ('+','-','*','/','**')
+
+# Functions available in expressions, as names of ObjectValue methods
+EXP_FUNCTIONS = {
+    'value': 'action_value',
+    'count': 'action_count',
+    'avg': 'action_avg',
+    'min': 'action_min',
+    'max': 'action_max',
+    'sum': 'action_sum',
+    'distinct_count': 'action_distinct_count',
+    'coalesce': 'action_coalesce',
+    }
+
+# Compiled expressions kept to be reused. They are bounded, as reports made at
+# runtime (i.e. by requests) can bring new expressions all the time
+EXPRESSIONS_CACHE_SIZE = 1000
+
+_compiled_expressions = LRUCache(EXPRESSIONS_CACHE_SIZE)
+_compiled_attribute_expressions = LRUCache(EXPRESSIONS_CACHE_SIZE)
+_not_compiled = object()
+
+def compile_expression(expression):
+    """Compiles an expression to a code object just once, returning it and
+    a flag telling if it has nested scopes (i.e. lambdas or comprehensions),
+    that can't see names from a local namespace"""
+    ret = _compiled_expressions.get(expression)
+    if ret is None:
+        code = compile(expression, '<expression>', 'eval')
+        nested = bool([c for c in code.co_consts if isinstance(c, types.CodeType)])
+
+        ret = code, nested
+        _compiled_expressions.set(expression, ret)
+
+    return ret
+
+def compile_attribute_expression(attribute_name):
+    """Compiles an arithmetic attribute name (like 'price*quantity') replacing
+    its attributes by placeholders. Returns the code object and the list of
+    placeholders with their attributes, or None if it is a simple attribute."""
+    ret = _compiled_attribute_expressions.get(attribute_name, _not_compiled)
+    if ret is not _not_compiled:
+        return ret
+
+    parts = EXP_TOKENS.split(attribute_name)
+    if len(list(filter(bool, parts))) > 1:
+        placeholders = {}
+        for num, part in enumerate(parts):
+            if num % 2 and part not in EXP_OPERATORS and not part[0].isdigit():
+                parts[num] = placeholders.setdefault(part, '_v%d'%len(placeholders))
+
+        names = [(name, part) for part, name in placeholders.items()]
+        ret = compile(''.join(parts), '<expression>', 'eval'), names
+    else:
+        ret = None
+
+    _compiled_attribute_expressions.set(attribute_name, ret)
+    return ret
+
+class ExpressionNamespace(object):
+    """Local namespace for expressions, resolving names on demand from the
+    expression functions, the parent object (for subreports) and the instance
+    values, instead of copying them all for each object."""
+
+    def __init__(self, widget):
+        self.widget = widget
+        self.assigned = {}
+
+        if not widget.instance:
+            self.values = {}
+        elif isinstance(widget.instance, dict):
+            self.values = widget.instance
+        else:
+            self.values = widget.instance.__dict__
+
+    def __getitem__(self, name):
+        if name in self.assigned:
+            return self.assigned[name]
+        elif name in EXP_FUNCTIONS:
+            return getattr(self.widget, EXP_FUNCTIONS[name])
+        elif name in ('parent', 'p') and isinstance(self.widget.report, SubReport):
+            return self.widget.report.parent_object # 'p' is just a short alias
+
+        return self.values[name]
+
+    def __setitem__(self, name, value):
+        self.assigned[name] = value
+
+    def as_dict(self):
+        ret = self.values.copy()
+        ret.update(dict([(name, self[name]) for name in EXP_FUNCTIONS]))
+
+        if isinstance(self.widget.report, SubReport):
+            ret['parent'] = ret['p'] = self['parent']
+
+        return ret
+
+_expression_globals = {}
 
 class ObjectValue(Label):
     """This shows the value from a method, field or property from objects got
@@ -135,6 +233,13 @@ class ObjectValue(Label):
 
             self.expression = EXP_QUOTED_SUB.sub('("%s"%s)'%(f[0][0], f[0][1]), self.expression, 1)
 
+        # Syntax errors are raised only when evaluating, to be handled by
+        # 'on_expression_error'
+        try:
+            compile_expression(self.expression)
+        except SyntaxError:
+            pass
+
     def get_object_value(self, instance=None, attribute_name=None):
         """Return the attribute value for just an object"""
         instance = instance or self.instance
@@ -148,17 +253,14 @@ class ObjectValue(Label):
                 return self.get_value(instance)
 
         # Checks this is an expression
-        tokens = EXP_TOKENS.split(attribute_name)
-        tokens = list(filter(bool, tokens)) # Cleans empty parts
-        if len(tokens) > 1:
-            values = {}
-            for token in tokens:
-                if not token in ('+','-','*','/','**') and not  token.isdigit():
-                    values[token] = self.get_object_value(instance, token)
-            return eval(attribute_name, values)
-
-        # Gets value with function
-        value = get_attr_value(instance, attribute_name)
+        compiled = compile_attribute_expression(attribute_name)
+        if compiled:
+            code, names = compiled
+            values = dict([(name, self.get_object_value(instance, token)) for name, token in names])
+            return eval(code, values)
+
+        # Gets value with the compiled accessor
+        value = get_attr_accessor(attribute_name)(instance)
 
         # For method attributes --- FIXME: check what does this code here, because
         #                           get_attr_value has a code to do that, using
@@ -175,28 +277,45 @@ class ObjectValue(Label):
         objects = self.generator.get_current_queryset()
         return [self.get_object_value(obj, attribute_name) for obj in objects]
 
-    def _clean_empty_values(self, values):
-        def clean(val):
-            if not val:
-                return 0
-            elif isinstance(val, decimal.Decimal) and self.converts_decimal_to_float:
-                return float(val)
-            elif isinstance(val, float) and self.converts_float_to_decimal:
-                return decimal.Decimal(str(val))
-            
-            return val
+    def get_aggregator(self, attribute_name=None):
+        """Returns the generator's accumulator with the precalculated values for
+        this widget in the current scope, or None if it is not available"""
+        aggregations = getattr(self.generator, 'aggregations', None)
+        if aggregations is None:
+            return None
+
+        return aggregations.get_accumulator(self, attribute_name or self.attribute_name)
+
+    def _clean_empty_value(self, val):
+        if not val:
+            return 0
+        elif isinstance(val, decimal.Decimal) and self.converts_decimal_to_float:
+            return float(val)
+        elif isinstance(val, float) and self.converts_float_to_decimal:
+            return decimal.Decimal(str(val))
+        
+        return val
 
-        return list(map(clean, values))
+    def _clean_empty_values(self, values):
+        return list(map(self._clean_empty_value, values))
 
     def action_value(self, attribute_name=None):
         return self.get_object_value(attribute_name=attribute_name)
 
     def action_count(self, attribute_name=None):
+        aggregator = self.get_aggregator(attribute_name)
+        if aggregator:
+            return aggregator.count()
+
         # Returns the total count of objects with valid values on informed attribute
         values = self.get_queryset_values(attribute_name)
         return len([v for v in values if v is not None])
 
     def action_avg(self, attribute_name=None):
+        aggregator = self.get_aggregator(attribute_name)
+        if aggregator:
+            return aggregator.avg()
+
         values = self.get_queryset_values(attribute_name)
 
         # Clear empty values
@@ -205,14 +324,26 @@ class ObjectValue(Label):
         return sum(values) / len(values)
 
     def action_min(self, attribute_name=None):
+        aggregator = self.get_aggregator(attribute_name)
+        if aggregator:
+            return aggregator.min()
+
         values = self.get_queryset_values(attribute_name)
         return min(values)
 
     def action_max(self, attribute_name=None):
+        aggregator = self.get_aggregator(attribute_name)
+        if aggregator:
+            return aggregator.max()
+
         values = self.get_queryset_values(attribute_name)
         return max(values)
 
     def action_sum(self, attribute_name=None):
+        aggregator = self.get_aggregator(attribute_name)
+        if aggregator:
+            return aggregator.sum()
+
         values = self.get_queryset_values(attribute_name)
 
         # Clear empty values
@@ -221,6 +352,10 @@ class ObjectValue(Label):
         return sum(values)
 
     def action_distinct_count(self, attribute_name=None):
+        aggregator = self.get_aggregator(attribute_name)
+        if aggregator:
+            return aggregator.distinct_count()
+
         values = [v for v in self.get_queryset_values(attribute_name) if v is not None]
         return len(set(values))
 
@@ -262,6 +397,7 @@ class ObjectValue(Label):
         new.stores_text_in_cache = self.stores_text_in_cache
         new.expression = self.expression
         new.on_expression_error = self.on_expression_error
+        new.get_text = self.get_text
 
         return new
 
@@ -269,35 +405,18 @@ class ObjectValue(Label):
         """Parses a given expression to get complex calculated values"""
 
         expression = expression or self.expression
-
-        if not self.instance:
-            global_vars = {}
-        elif isinstance(self.instance, dict):
-            global_vars = self.instance.copy()
-        else:
-            global_vars = self.instance.__dict__.copy()
-
-        global_vars.update({
-            'value': self.action_value,
-            'count': self.action_count,
-            'avg': self.action_avg,
-            'min': self.action_min,
-            'max': self.action_max,
-            'sum': self.action_sum,
-            'distinct_count': self.action_distinct_count,
-            'coalesce': self.action_coalesce,
-            })
-
-        if isinstance(self.report, SubReport):
-            global_vars.update({
-                'parent': self.report.parent_object,
-                'p': self.report.parent_object, # Just a short alias
-                })
+        namespace = ExpressionNamespace(self)
 
         try:
-            return eval(expression, global_vars)
+            code, nested = compile_expression(expression)
+
+            # Nested scopes see only global names
+            if nested:
+                return eval(code, namespace.as_dict())
+
+            return eval(code, _expression_globals, namespace)
         except Exception as e:
-            if not isinstance(self.on_expression_error, collections.Callable):
+            if not callable(self.on_expression_error):
                 raise
 
             return self.on_expression_error(self, e, expression, self.instance)
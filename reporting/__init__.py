@@ -24,7 +24,12 @@ from django.template import RequestContext
 from django.utils.translation import ugettext as _
 from django.conf import settings
 
-from geraldo.generators import PDFGenerator
+from geraldo.generators import PDFGenerator, CSVGenerator
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    StreamingHttpResponse = None
 
 exp_report = re.compile('^(?P<app>[\w_]+)/(?P<model>[\w_]+)/(?P<name>[\w_-]+)/$')
 
@@ -74,21 +79,44 @@ class ReportSite(object):
         # Find the registered report for this URL
         registered = self.get_report_by_url(request)
 
-        # Initialize the reponse object
-        resp = HttpResponse(mimetype='application/pdf')
-        resp['Content-Disposition'] = 'filename=%s.pdf'%'-'.join([app, model, name])
-
         # Get the queryset
         queryset = self.get_queryset(request, registered['model'])
 
         # Initialize the report instance
         report = registered['report'](queryset=queryset)
 
+        # CSV output
+        if request.GET.get('format', None) == 'csv':
+            return self.csv_response(report, '-'.join([app, model, name]))
+
+        # Initialize the reponse object
+        resp = HttpResponse(mimetype='application/pdf')
+        resp['Content-Disposition'] = 'filename=%s.pdf'%'-'.join([app, model, name])
+
         # Generate report into response object
         report.generate_by(PDFGenerator, filename=resp)
 
         return resp
 
+    def csv_response(self, report, filename):
+        """Returns a response with the report in CSV format. If Django supports
+        streaming responses, the queryset is iterated and the output is sent in
+        chunks as rows are extracted, so memory doesn't depend on its size.
+
+        CSV output is never cached, by this or the other way, so the report's
+        'cache_status' doesn't change it."""
+        if StreamingHttpResponse is not None:
+            report.stream_queryset = True
+            generator = CSVGenerator(report)
+            resp = StreamingHttpResponse(generator.generate_chunks(), content_type=generator.mimetype)
+        else:
+            resp = HttpResponse(mimetype=CSVGenerator.mimetype)
+            report.generate_by(CSVGenerator, filename=resp)
+
+        resp['Content-Disposition'] = 'attachment; filename=%s.csv'%filename
+
+        return resp
+
     def get_adminmodel(self, model):
         from django.contrib.admin import site
         modeladmin = site._registry[model]
@@ -109,7 +137,7 @@ class ReportSite(object):
 
         # Get filters
         filter = dict([(str(k),v) for k,v in list(request.GET.items())\
-            if not k in ('o','ot','q','p')])
+            if not k in ('o','ot','q','p','format')])
         
         # Get the queryset
         queryset = model.objects.all()